@@ -1,7 +1,7 @@
 __author__ = 'Larry'
 
 import logging; logging.basicConfig(level=logging.INFO)
-import asyncio, os, json, time
+import asyncio, os, json, signal, time
 from datetime import datetime
 from aiohttp import web
 from jinja2 import Environment, FileSystemLoader
@@ -56,6 +56,20 @@ async def logger_factory(app, handler):
     return logger
 
 
+# 在auth之前打开ORM的请求级作用域，这样cookie2user和视图函数共享同一份身份映射：
+# 同一请求内重复的Model.find()只查询一次数据库，写过主库后的读也走主库
+# 请求的数据库耗时写入日志和Server-Timing响应头，浏览器的开发者工具中可以看到
+async def orm_factory(app, handler):
+    async def orm_scope(request):
+        with orm.request_scope() as timing:
+            r = await handler(request)
+        if isinstance(r, web.StreamResponse) and not r.prepared:
+            r.headers['Server-Timing'] = timing.server_timing()
+        logging.info('Timing: %s %s %s' % (request.method, request.path, timing))
+        return r
+    return orm_scope
+
+
 # 利用middle在处理URL之前，把cookie解析出来，并将登录用户绑定到request对象上，
 # 这样，后续的URL处理函数就可以直接拿到登录用户：
 async def auth_factory(app, handler):
@@ -74,6 +88,13 @@ async def auth_factory(app, handler):
     return auth
 
 
+def json_default(o):
+    # Model的列保存在__slots__中，用to_dict()转换；其他对象（如Page）以__dict__返回属性和值的映射
+    if isinstance(o, orm.Model):
+        return o.to_dict()
+    return o.__dict__
+
+
 # 处理视图函数返回值，制作response的middleware
 # 请求对象request的处理工序：
 #            logger_factory => response_factory => RequestHandler().__call__ => handler
@@ -85,6 +106,8 @@ async def response_factory(app, handler):
     async def response(request):
         logging.info('Response handler...')
         r = await handler(request)
+        if isinstance(r, orm.Model):  # 单个Model对象，按dict返回json
+            r = r.to_dict()
         if isinstance(r, web.StreamResponse):   # StreamResponse是所有Response对象的父类
             return r  # 无需构造，直接返回
         if isinstance(r, bytes):  # 继承自StreamResponse，接受body参数，构造HTTP响应内容
@@ -103,11 +126,10 @@ async def response_factory(app, handler):
             # 在后续构造视图函数返回值时，会加入__template__值，用以选择渲染的模板
             template = r.get('__template__')
             if template is None:  # 不带模板信息，返回json对象
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=json_default).encode('utf-8'))
 
                 # ensure_ascii：默认True，仅能输出ascii格式数据。故设置为False。
                 # default：r对象会先被传入default中的函数进行处理，然后才被序列化为json对象
-                # __dict__：以dict形式返回对象属性和值的映射
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             else:  # 带模板信息，渲染模板
@@ -150,11 +172,15 @@ if __name__ == '__main__':
     async def init(loop):
         await orm.create_pool(loop, **configs['db'])
         app = web.Application(loop=loop, middlewares=[
-            logger_factory, auth_factory, response_factory
+            logger_factory, orm_factory, auth_factory, response_factory
         ])
         init_jinja2(app, filters=dict(datetime=datetime_filter))
         add_routes(app, 'handlers')
         add_static(app)
+        if configs.db.get('create_tables'):
+            await orm.create_tables()
+        # 声明了但数据库中缺少的索引只记录警告，不自动创建
+        await orm.check_indexes()
         srv = await loop.create_server(app.make_handler(), '127.0.0.1', 9000)
         logging.info('Server started at http://127.0.0.1:9000...')
         return srv
@@ -162,4 +188,12 @@ if __name__ == '__main__':
 
     loop = asyncio.get_event_loop()
     loop.run_until_complete(init(loop))
-    loop.run_forever()
+    # supervisor、fab重启时发送SIGTERM：停止事件循环，同样走下面的destroy_pool()
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # 退出前写完写后队列中的对象
+        loop.run_until_complete(orm.destroy_pool())
@@ -9,11 +9,42 @@ __author__ = 'Larry'
 configs = {
     'debug': True,
     'db': {
+        # 'mysql'或'sqlite'；sqlite使用进程内的数据库文件（'database'项，默认为awesome.db），不需要数据库服务器
+        'backend': 'mysql',
+        # 启动时创建不存在的表和索引，使用sqlite时通常打开
+        'create_tables': False,
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'www-data',
         'password': 'www-data',
-        'db': 'awesome'
+        'db': 'awesome',
+        # 连接池大小的上下限，实际大小按取连接的等待时间在两者之间调整；启动时预先建立warmup个连接
+        'minsize': 1,
+        'maxsize': 10,
+        'warmup': 5,
+        # 单条语句和一个请求中所有语句的超时（秒），超时的语句在数据库中止并丢弃连接；None为不限制
+        'query_timeout': 10,
+        'request_timeout': 30,
+        # 每个请求在第一次查询时取一个主库连接，之后的查询都复用它，请求结束时归还
+        'pin_request_connection': False,
+        # 一个请求中orm.gather()同时执行的加载数上限
+        'fanout_limit': 4,
+        # 写后队列：这些表的插入先放在内存中，攒成多行INSERT再写入，如
+        # {'comments': {'batch_size': 100, 'interval': 0.05, 'maxsize': 10000}}，interval为秒，maxsize为队列上限
+        'write_behind': {},
+        # 只读从库，每项只需写出与主库不同的配置，如 {'host': '10.0.0.2'}；为空时读写都走主库
+        'replicas': [],
+        # select()结果缓存，写入表时自动失效
+        'cache': {
+            'enabled': False,
+            'maxsize': 1000,
+            'ttl': 30
+        },
+        # 查询记录：超过slow_ms毫秒的查询连同参数和EXPLAIN保存下来，其余按sample_rate抽样
+        'recorder': {
+            'slow_ms': 200,
+            'sample_rate': 0.01
+        }
     },
     'session': {
         'secret': 'Awesome'
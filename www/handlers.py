@@ -9,14 +9,24 @@ import markdown2
 from aiohttp import web
 
 from coroweb import get, post
-from apis import APIError, APIValueError, APIResourceNotFoundError, APIPermissionError, Page
+from apis import APIError, APIValueError, APIResourceNotFoundError, APIPermissionError
 
+import orm
 from models import User, Blog, Comment, next_id
 from config import configs
 
 COOKIE_NAME = 'awesession'
 _COOKIE_KEY = configs.session.secret
 
+# 列表页使用的查询，只构造一次，SQL由orm按查询形状缓存；用fetch_page()分页
+# 按(created_at, id)排序，这样分页游标可以用键集定位；只查询页面用到的列
+_BLOGS_BY_DATE = Blog.query().order_by(Blog.column('created_at').desc(), Blog.column('id').desc())
+_BLOG_SUMMARIES = _BLOGS_BY_DATE.columns('name', 'summary', 'created_at')
+_BLOG_ROWS = _BLOGS_BY_DATE.columns('user_id', 'user_name', 'name', 'created_at')
+_COMMENTS_BY_DATE = Comment.query().order_by(Comment.column('created_at').desc(), Comment.column('id').desc())
+_USERS_BY_DATE = User.query().order_by(User.column('created_at').desc(), User.column('id').desc()) \
+    .columns('email', 'admin', 'name', 'image', 'created_at')
+
 
 def check_admin(request):
     if request.__user__ is None or not request.__user__.admin:
@@ -45,6 +55,21 @@ def user2cookie(user, max_age):
     return '-'.join(cookie_comps)
 
 
+async def fetch_page(query, page_index, after, before):
+    ''' 分页查询，返回(对象列表, Page)；after/before游标不合法时返回参数错误 '''
+    try:
+        return await query.page(page_index, after=after, before=before)
+    except ValueError:
+        raise APIValueError('cursor', 'Invalid page cursor.')
+
+
+async def add_comment_counts(blogs):
+    ''' 一条分组查询取出这一页日志的评论数，设为blog.comment_count '''
+    counts = await Comment.aggregate('blog_id', keys=[blog.id for blog in blogs], default=0)
+    for blog in blogs:
+        blog.comment_count = counts[blog.id]
+
+
 def text2html(text):
     lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'), filter(lambda s: s.strip() != '', text.split('\n')))
     return ''.join(lines)
@@ -63,7 +88,8 @@ async def cookie2user(cookie_str):
         uid, expires, sha1 = cookie_comps
         if int(expires) < time.time():
             return None
-        user = await User.find(uid)
+        # 并发请求的用户查询合并成一条IN查询
+        user = await User.find_batched(uid)
         if user is None:
             return None
         s = '%s-%s-%s-%s' % (uid, user.passwd, expires, _COOKIE_KEY)
@@ -78,15 +104,12 @@ async def cookie2user(cookie_str):
 
 
 @get('/')
-async def index(request, *, page='1'):
+async def index(request, *, page='1', after=None, before=None):
     """ 首页 """
     # 视图函数返回的值是dict
     page_index = get_page_index(page)
-    num = await Blog.findnumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        blogs = []
-    blogs = await Blog.findall(orgerBy='created_at desc', limit=(p.offset, p.limit))
+    blogs, p = await fetch_page(_BLOG_SUMMARIES, page_index, after, before)
+    await add_comment_counts(blogs)
     return {
         # 在response_middleware中会搜索模板
         '__template__': 'blogs.html',
@@ -99,8 +122,11 @@ async def index(request, *, page='1'):
 @get('/blog/{id}')
 async def get_blog(id, request):
     """ 日志详情页 """
-    blog = await Blog.find(id)
-    comments = await Comment.findall('blog_id=?', [id], orgerBy='created_at desc')
+    # 评论可能还在写后队列中，先让作者读到自己刚发表的评论
+    if request.__user__ is not None:
+        await Comment.sync_writes(request.__user__.id)
+    # 日志和评论互不依赖，同时查询
+    blog, comments = await orm.gather(Blog.find(id), Comment.findall('blog_id=?', [id], orgerBy='created_at desc'))
     for c in comments:
         c.html_content = text2html(c.content)
     blog.html_content = markdown2.markdown(blog.content)
@@ -150,7 +176,7 @@ async def authenticate(*, email, passwd):
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
     user.passwd = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = json.dumps(user.to_dict(), ensure_ascii=False).encode('utf-8')
     return r
 
 
@@ -170,21 +196,25 @@ def manage():
 
 
 @get('/manage/comments')
-async def manage_comments(request, *, page='1'):
+async def manage_comments(request, *, page='1', after='', before=''):
     """ 日志列表页 """
     return {
         '__template__': 'manage_comments.html',
         'page_index': get_page_index(page),
+        'after': after,
+        'before': before,
         '__user__': request.__user__
     }
 
 
 @get('/manage/blogs')
-async def manage_blogs(request, *, page='1'):
+async def manage_blogs(request, *, page='1', after='', before=''):
     """ 日志列表页 """
     return {
         '__template__': 'manage_blogs.html',
         'page_index': get_page_index(page),
+        'after': after,
+        'before': before,
         '__user__': request.__user__
     }
 
@@ -212,25 +242,23 @@ async def manage_edit_blog(request, *, id):
 
 
 @get('/manage/users')
-async def manage_users(request, *, page='1'):
+async def manage_users(request, *, page='1', after='', before=''):
     """ 用户列表页 """
     return {
         '__template__': 'manage_users.html',
         'page_index': get_page_index(page),
+        'after': after,
+        'before': before,
         '__user__': request.__user__
     }
 
 
 @get('/api/comments')
-async def api_comments(*, page='1'):
+async def api_comments(*, page='1', after=None, before=None):
     """ 获取评论 """
     page_index = get_page_index(page)
-    num = await Comment.findnumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, comments=())
-    blogs = await Comment.findall(orgerBy='created_at desc', limit=(p.offset, p.limit))
-    return dict(page=p, comments=blogs)
+    comments, p = await fetch_page(_COMMENTS_BY_DATE, page_index, after, before)
+    return dict(page=p, comments=comments)
 
 
 @post('/api/blogs/{id}/comments')
@@ -245,7 +273,8 @@ async def api_create_comment(id, request, *, content):
     if blog is None:
         raise APIResourceNotFoundError('Blog')
     comment = Comment(blog_id=id, user_id=user.id, user_name=user.name, user_image=user.image, content=content.strip())
-    await comment.save()
+    # 配置了写后队列时稍后批量写入
+    await comment.save_later(owner=user.id)
     return comment
 
 
@@ -253,26 +282,18 @@ async def api_create_comment(id, request, *, content):
 async def api_delete_comment(id, request):
     """ 删除评论 """
     check_admin(request)
-    comment = await Comment.find(id)
-    if comment is None:
+    if await Comment.delete_by_pk(id) == 0:
         raise APIResourceNotFoundError('Comment')
-    await comment.remove()
     return dict(id=id)
 
 
 @get('/api/users')
-async def api_get_users(*, page='1'):
+async def api_get_users(*, page='1', after=None, before=None):
     """ 获取用户 """
     page_index = get_page_index(page)
-    num = await User.findnumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, users=())
-    users = await User.findall(orgerBy='created_at desc', limit=(p.offset, p.limit))
+    # 不查询passwd列
+    users, p = await fetch_page(_USERS_BY_DATE, page_index, after, before)
     return dict(page=p, users=users)
-    for u in users:
-        u.passwd = '******'
-    return dict(users=users)
 
 
 _RE_EMAIL = re.compile(r'^[a-z0-9\.\-\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$')
@@ -288,31 +309,33 @@ async def api_register_user(*, email, name, passwd):
         raise APIValueError('email')
     if not passwd or not _RE_SHA1.match(passwd):
         raise APIValueError('passwd')
-    users = await User.findall('email=?',[email])
-    if len(users) > 0:
-        raise APIError('register:failed', 'email', 'Email is already in use.')
+    # 确认email上有唯一索引时重复注册由数据库拒绝，不必先查询一次；没有这个索引的旧数据库仍要先查询
+    if not orm.has_unique_index(User, 'email'):
+        users = await User.findall('email=?', [email])
+        if len(users) > 0:
+            raise APIError('register:failed', 'email', 'Email is already in use.')
     uid = next_id()
     sha1_passwd = '%s:%s' % (uid, passwd)
     user = User(id=uid, name=name.strip(), email=email, passwd=hashlib.sha1(sha1_passwd.encode('utf-8')).hexdigest(), image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email.encode('utf-8')).hexdigest())
-    await user.save()
+    try:
+        await user.save()
+    except orm.DuplicateKeyError:
+        raise APIError('register:failed', 'email', 'Email is already in use.')
     # make session cookie:
     r = web.Response()
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
     user.passwd = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = json.dumps(user.to_dict(), ensure_ascii=False).encode('utf-8')
     return r
 
 
 @get('/api/blogs')
-async def api_blogs(*, page='1'):
+async def api_blogs(*, page='1', after=None, before=None):
     """ 获取日志 """
     page_index = get_page_index(page)
-    num = await Blog.findnumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, blogs=())
-    blogs = await Blog.findall(orgerBy='created_at desc', limit=(p.offset, p.limit))
+    blogs, p = await fetch_page(_BLOG_ROWS, page_index, after, before)
+    await add_comment_counts(blogs)
     return dict(page=p, blogs=blogs)
 
 
@@ -343,6 +366,8 @@ async def api_update_blog(id, request, *, name, summary, content):
     """ 修改日志 """
     check_admin(request)
     blog = await Blog.find(id)
+    if blog is None:
+        raise APIResourceNotFoundError('Blog')
     if not name or not name.strip():
         raise APIValueError('name', 'name can not be empty.')
     if not summary or not summary.strip():
@@ -352,6 +377,7 @@ async def api_update_blog(id, request, *, name, summary, content):
     blog.name = name.strip()
     blog.summary = summary.strip()
     blog.content = content.strip()
+    # 只写回有变化的列，内容没改时不重写content
     await blog.update()
     return blog
 
@@ -360,6 +386,14 @@ async def api_update_blog(id, request, *, name, summary, content):
 async def api_delete_blog(id, request):
     """ 删除日志 """
     check_admin(request)
-    blog = await Blog.find(id)
-    await blog.remove()
+    if await Blog.delete_by_pk(id) == 0:
+        raise APIResourceNotFoundError('Blog')
     return dict(id=id)
+
+
+@get('/api/metrics')
+async def api_metrics(request):
+    """ 数据库连接池、查询缓存、查询耗时和写后队列指标 """
+    check_admin(request)
+    return dict(pools=orm.pool_stats(), query_cache=orm.cache_stats(), queries=orm.query_stats(),
+                write_behind=orm.write_behind_stats())
@@ -8,7 +8,7 @@ __author__ = 'Larry'
 
 import time
 import uuid
-from orm import Model, StringField, BooleanField, FloatField, TextField
+from orm import Model, StringField, BooleanField, FloatField, TextField, Index
 
 
 def next_id():
@@ -19,12 +19,12 @@ class User(Model):
     __table__ = 'users'
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    email = StringField(ddl='varchar(50)')
+    email = StringField(ddl='varchar(50)', unique=True)
     passwd = StringField(ddl='varchar(50)')
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(500)')
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
 
 
 class Blog(Model):
@@ -36,12 +36,14 @@ class Blog(Model):
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
-    created_at = FloatField(default=time.time)
+    content = TextField(deferred=True)
+    created_at = FloatField(default=time.time, index=True)
 
 
 class Comment(Model):
     __table__ = 'comments'
+    # 日志详情页按blog_id查询评论并按created_at排序
+    __indexes__ = (Index('blog_id', 'created_at'),)
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     blog_id = StringField(ddl='varchar(50)')
@@ -49,6 +51,6 @@ class Comment(Model):
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     content = TextField()
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
 
 
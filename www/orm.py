@@ -1,73 +1,1078 @@
 __author__ = 'Larry'
 
-import aiomysql
+import asyncio
+import bisect
+import collections
+import contextlib
+import contextvars
+import functools
 import logging
+import random
+import re
+import time
+import weakref
 logging.basicConfig(level=logging.INFO)
 
+from pagination import Page, decode_cursor
 
-def log(sql, args=()):
-    logging.info('SQL: %s' % sql)
+# 只使用sqlite后端时可以不安装aiomysql
+try:
+    import aiomysql
+except ImportError:
+    aiomysql = None
+
+
+class MySQLBackend(object):
+    """ 默认后端：aiomysql连接池 """
+
+    name = 'mysql'
+    table_options = ' engine=innodb default charset=utf8'
+    explain = 'explain '
+
+    def __init__(self):
+        self.driver = aiomysql
+        self._pool_kwargs = dict()  # {连接池: 配置}，KILL QUERY时用来建立新连接
+
+    async def create_pool(self, loop, kwargs):
+        if aiomysql is None:
+            raise RuntimeError('aiomysql is required for the mysql backend.')
+        pool = await aiomysql.create_pool(
+            host=kwargs.get('host', 'localhost'),
+            port=kwargs.get('port', 3306),
+            user=kwargs['user'],
+            password=kwargs['password'],
+            db=kwargs['db'],
+            charset=kwargs.get('charset', 'utf8'),
+            autocommit=kwargs.get('autocommit', True),
+            maxsize=kwargs.get('maxsize', 10),
+            minsize=kwargs.get('minsize', 1),
+            loop=loop
+        )
+        self._pool_kwargs[pool] = kwargs
+        return pool
+
+    def describe(self, kwargs):
+        return '%s:%s' % (kwargs.get('host', 'localhost'), kwargs.get('port', 3306))
+
+    async def kill(self, pool, conn):
+        """ 用一个新连接执行KILL QUERY，中止conn上正在执行的语句（连接池可能已经没有空闲连接） """
+        kwargs = self._pool_kwargs[pool]
+        killer = await aiomysql.connect(host=kwargs.get('host', 'localhost'), port=kwargs.get('port', 3306),
+                                        user=kwargs['user'], password=kwargs['password'], db=kwargs['db'])
+        try:
+            async with killer.cursor() as cur:
+                await cur.execute('kill query %s', (conn.thread_id(),))
+        finally:
+            killer.close()
+
+    def translate(self, sql):
+        return to_mysql(sql)
+
+    def cursor_class(self, tuples=False, stream=False):
+        return getattr(self.driver, '%s%sCursor' % ('SS' if stream else '', '' if tuples else 'Dict'))
+
+    @property
+    def disconnect_errors(self):
+        return (OSError, aiomysql.OperationalError)
+
+    def is_duplicate_key(self, e):
+        return isinstance(e, aiomysql.IntegrityError) and bool(e.args) and e.args[0] == ER_DUP_ENTRY
+
+    async def indexes(self, table):
+        """ 表上已有的索引：set((列tuple, 是否唯一)) """
+        rs = await select('select index_name, non_unique, column_name from information_schema.statistics '
+                          'where table_schema=database() and table_name=? order by index_name, seq_in_index',
+                          [table], primary=True)
+        existing = dict()
+        for r in rs:
+            r = dict((k.lower(), v) for k, v in r.items())
+            columns, unique = existing.get(r['index_name'], ((), False))
+            existing[r['index_name']] = (columns + (r['column_name'],), not int(r['non_unique']))
+        return set(existing.values())
+
+
+class SQLiteBackend(MySQLBackend):
+    """
+    进程内的SQLite（见sqlite_pool），适合单机部署和本地压测。
+    数据库文件由kwargs['database']指定，默认为'<db>.db'；SQL的?占位符不需要替换，
+    MySQL的on duplicate key update改写为SQLite的on conflict do update。
+    """
+
+    name = 'sqlite'
+    table_options = ''
+    explain = 'explain query plan '
+
+    def __init__(self):
+        import sqlite_pool
+        self.driver = sqlite_pool
+
+    async def create_pool(self, loop, kwargs):
+        return await self.driver.create_pool(
+            self.database(kwargs),
+            minsize=kwargs.get('minsize', 1),
+            maxsize=kwargs.get('maxsize', 10),
+            timeout=kwargs.get('busy_timeout', 5.0),
+            loop=loop
+        )
+
+    def database(self, kwargs):
+        return kwargs.get('database') or '%s.db' % kwargs['db']
+
+    def describe(self, kwargs):
+        return self.database(kwargs)
+
+    async def kill(self, pool, conn):
+        # sqlite3.Connection.interrupt()可以在其他线程调用，正在执行的语句会抛出OperationalError
+        conn.interrupt()
+
+    def translate(self, sql):
+        return to_sqlite(sql)
+
+    @property
+    def disconnect_errors(self):
+        return (OSError,)
+
+    def is_duplicate_key(self, e):
+        return isinstance(e, self.driver.IntegrityError) and 'UNIQUE constraint failed' in str(e)
+
+    async def indexes(self, table):
+        existing = set()
+        for index in await select('pragma index_list(`%s`)' % table, None, primary=True):
+            info = await select('pragma index_info(`%s`)' % index['name'], None, primary=True)
+            existing.add((tuple(r['name'] for r in sorted(info, key=lambda r: r['seqno'])), bool(index['unique'])))
+        return existing
+
+
+BACKENDS = {
+    'mysql': MySQLBackend,
+    'sqlite': SQLiteBackend
+}
+
+_backend = MySQLBackend()
 
 
 async def create_pool(loop, **kwargs):
+    """
+    创建主库连接池，以及kwargs['replicas']中每个从库的连接池。
+    从库配置只需写出与主库不同的项，如 {'host': '10.0.0.2'}。
+    kwargs['backend']选择后端：'mysql'（默认）或'sqlite'。
+    每个连接池启动时预先建立kwargs['warmup']个连接，之后在minsize和maxsize之间按等待时间自动调整大小（见PoolSizer）。
+    """
     logging.info('创建连接池...')
-    global __pool
-    __pool = await aiomysql.create_pool(
-        host=kwargs.get('host', 'localhost'),
-        port=kwargs.get('port', 3306),
-        user=kwargs['user'],
-        password=kwargs['password'],
-        db=kwargs['db'],
-        charset=kwargs.get('charset', 'utf8'),
-        autocommit=kwargs.get('autocommit', True),
-        maxsize=kwargs.get('maxsize', 10),
-        minsize=kwargs.get('minsize', 1),
-        loop=loop
-    )
-
-
-async def destroy_pool():
-    global __pool
-    if __pool is not None:
-        __pool.close()
-        await __pool.wait_closed()
-
-
-async def select(sql, args, size=None):
-    log(sql, args)
-    global __pool
-    with (await __pool) as conn:
-        cur = await conn.cursor(aiomysql.DictCursor)
-        '''SQL语句的占位符是?，而MySQL的占位符是%s，select()函数在内部自动替换.
-        注意要始终坚持使用带参数的SQL，而不是自己拼接SQL字符串，这样可以防止SQL注入攻击,'''
-        await cur.execute(sql.replace('?', '%s'), args or ())
+    global __pool, __replicas, _backend
+    backend = kwargs.get('backend', 'mysql')
+    if backend not in BACKENDS:
+        raise ValueError('Unknown database backend: %s' % backend)
+    _backend = BACKENDS[backend]()
+    __pool = await _backend.create_pool(loop, kwargs)
+    __replicas = []
+    _pool_stats.clear()
+    _pool_stats[__pool] = PoolStats('primary', __pool)
+    _pool_sizers.clear()
+    await _start_sizing(__pool, kwargs)
+    for i, override in enumerate(kwargs.get('replicas') or ()):
+        replica_kw = dict(kwargs)
+        replica_kw.update(override)
+        logging.info('创建从库连接池: %s' % _backend.describe(replica_kw))
+        replica = Replica('replica%d' % i, await _backend.create_pool(loop, replica_kw))
+        _pool_stats[replica.pool] = PoolStats(replica.name, replica.pool)
+        await _start_sizing(replica.pool, replica_kw)
+        __replicas.append(replica)
+    global _resizer
+    if _resizer is None:
+        _resizer = asyncio.ensure_future(_resize_pools())
+    global QUERY_TIMEOUT, REQUEST_TIMEOUT, PIN_REQUEST_CONNECTION, FANOUT_LIMIT
+    PIN_REQUEST_CONNECTION = kwargs.get('pin_request_connection', False)
+    FANOUT_LIMIT = kwargs.get('fanout_limit', FANOUT_LIMIT)
+    _write_behind_options.update(kwargs.get('write_behind') or {})
+    QUERY_TIMEOUT = kwargs.get('query_timeout')
+    REQUEST_TIMEOUT = kwargs.get('request_timeout')
+    configure_recorder(**(kwargs.get('recorder') or {}))
+    cache = kwargs.get('cache') or {}
+    if cache.get('enabled'):
+        enable_query_cache(cache.get('maxsize', 1000), cache.get('ttl', 30))
+
+
+async def destroy_pool(write_behind_timeout=None):
+    """ write_behind_timeout为等待写后队列写完的秒数，默认WRITE_BEHIND_CLOSE_TIMEOUT """
+    global __pool, __replicas, _resizer
+    # 先写完写后队列中的对象，再关闭连接池；数据库不可用时不会一直等下去
+    await close_write_behind(WRITE_BEHIND_CLOSE_TIMEOUT if write_behind_timeout is None else write_behind_timeout)
+    if _resizer is not None:
+        _resizer.cancel()
+        _resizer = None
+    _pool_sizers.clear()
+    for pool in [__pool] + [r.pool for r in __replicas]:
+        if pool is not None:
+            pool.close()
+            await pool.wait_closed()
+    __replicas = []
+    # 行数、已确认的索引和查询缓存都属于这次的数据库，不能带到下一次create_pool()
+    for counter in _row_counts.values():
+        if counter._reconciling is not None:
+            counter._reconciling.cancel()
+    _row_counts.clear()
+    _existing_indexes.clear()
+    disable_query_cache()
+
+
+__pool = None
+__replicas = []
+
+# 从库出现连接错误后，在这段时间（秒）内不再分配读请求
+REPLICA_COOLDOWN = 30
+
+# 当前请求（Task）是否已经写过主库。写过之后的读都走主库，避免从库复制延迟导致读不到刚写入的数据
+_wrote_primary = contextvars.ContextVar('orm_wrote_primary', default=False)
+
+
+class Replica(object):
+    """ 从库连接池及其健康状态 """
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.inflight = 0
+        self.down_until = 0
+
+    @property
+    def healthy(self):
+        return self.down_until <= time.time()
+
+    def mark_down(self, e):
+        logging.warning('replica %s is down for %ss: %s' % (self.name, REPLICA_COOLDOWN, e))
+        self.down_until = time.time() + REPLICA_COOLDOWN
+
+
+def choose_replica():
+    """ 在健康的从库中选择进行中查询最少的一个；没有可用从库或本请求写过主库时返回None """
+    if not __replicas or _wrote_primary.get():
+        return None
+    best = None
+    for r in __replicas:
+        if r.healthy and (best is None or r.inflight < best.inflight):
+            best = r
+    return best
+
+
+@functools.lru_cache(maxsize=512)
+def to_mysql(sql):
+    '''SQL语句的占位符是?，而MySQL的占位符是%s，在这里统一替换，并缓存替换结果.
+    注意要始终坚持使用带参数的SQL，而不是自己拼接SQL字符串，这样可以防止SQL注入攻击,'''
+    return sql.replace('?', '%s')
+
+
+_RE_UPSERT_VALUES = re.compile(r'values\((`?\w+`?)\)', re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=512)
+def to_sqlite(sql):
+    ''' 占位符不变；把MySQL的 on duplicate key update `f`=values(`f`) 改写为 on conflict do update set `f`=excluded.`f` '''
+    head, sep, tail = sql.partition(' on duplicate key update ')
+    if not sep:
+        return sql
+    return '%s on conflict do update set %s' % (head, _RE_UPSERT_VALUES.sub(r'excluded.\1', tail))
+
+
+class Histogram(object):
+    """ 固定桶的耗时直方图，单位毫秒 """
+
+    BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, ms):
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+        self.counts[bisect.bisect_left(self.BUCKETS, ms)] += 1
+
+    def percentile(self, q):
+        """ 按桶估算的分位数（所在桶的上界，不超过最大值） """
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, n in zip(self.BUCKETS, self.counts):
+            seen += n
+            if seen >= target:
+                return min(float(bound), self.max)
+        return self.max
+
+    def snapshot(self):
+        buckets = dict(('le_%s' % b, n) for b, n in zip(self.BUCKETS, self.counts))
+        buckets['le_inf'] = self.counts[-1]
+        return dict(count=self.count, sum=round(self.total, 3), max=round(self.max, 3),
+                    avg=round(self.total / self.count, 3) if self.count else 0.0,
+                    p50=self.percentile(0.5), p95=self.percentile(0.95), p99=self.percentile(0.99),
+                    buckets=buckets)
+
+
+class PoolStats(object):
+    """ 一个连接池的指标：等待取连接的耗时、持有连接的耗时、查询耗时，以及当前等待者数量 """
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.waiters = 0
+        self.wait = Histogram()
+        self.hold = Histogram()
+        self.query = Histogram()
+
+    def snapshot(self):
+        pool = self.pool
+        sizer = _pool_sizers.get(pool)
+        return dict(size=pool.size, maxsize=pool.maxsize, free=pool.freesize,
+                    target=sizer.limit if sizer is not None else pool.maxsize,
+                    in_use=pool.size - pool.freesize, waiters=self.waiters,
+                    wait_ms=self.wait.snapshot(), hold_ms=self.hold.snapshot(), query_ms=self.query.snapshot())
+
+
+# {连接池: PoolStats}
+_pool_stats = dict()
+
+
+def stats_of(pool):
+    stats = _pool_stats.get(pool)
+    if stats is None:
+        name = 'primary' if pool is __pool else next((r.name for r in __replicas if r.pool is pool), 'pool')
+        stats = _pool_stats[pool] = PoolStats(name, pool)
+    return stats
+
+
+def pool_stats():
+    """ 返回所有连接池指标的快照，供metrics接口或日志使用 """
+    return dict((stats.name, stats.snapshot()) for stats in _pool_stats.values())
+
+
+@contextlib.asynccontextmanager
+async def acquire(pool):
+    """ 从连接池取连接，记录等待时间和持有时间 """
+    conn, acquired = await checkout(pool)
+    try:
+        yield conn
+    finally:
+        checkin(pool, conn, acquired)
+
+
+async def checkout(pool):
+    """
+    从连接池取连接并记录等待时间，返回(连接, 取出的时间)；用完后必须调用checkin()。
+    有请求的截止时间时，等待连接也不超过截止时间，超时抛出QueryTimeout。
+    """
+    stats = stats_of(pool)
+    sizer = _pool_sizers.get(pool)
+    deadline = _deadline.get()
+    stats.waiters += 1
+    start = time.perf_counter()
+    try:
+        waiting = pool.acquire() if sizer is None else sizer.acquire()
+        if deadline is None:
+            conn = await waiting
+        else:
+            try:
+                conn = await asyncio.wait_for(waiting, max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                raise QueryTimeout('timed out waiting for a connection from %s' % stats.name)
+    finally:
+        stats.waiters -= 1
+    acquired = time.perf_counter()
+    stats.wait.observe((acquired - start) * 1000)
+    return conn, acquired
+
+
+def checkin(pool, conn, acquired):
+    """ 归还checkout()取出的连接，记录持有时间 """
+    sizer = _pool_sizers.get(pool)
+    if sizer is None:
+        pool.release(conn)
+    else:
+        sizer.release(conn)
+    stats_of(pool).hold.observe((time.perf_counter() - acquired) * 1000)
+
+
+# 连接闲置超过这么多秒，取出时先ping一次，失效的连接直接丢弃
+POOL_PING_IDLE = 30
+# 每隔多少秒按等待时间调整一次连接池大小
+POOL_RESIZE_INTERVAL = 5
+# 一个周期内有取连接等待超过这么多毫秒，就扩大连接池
+POOL_GROW_WAIT_MS = 10
+# 连续这么多秒用不满时缩小连接池
+POOL_SHRINK_AFTER = 60
+
+
+class PoolSizer(object):
+    """
+    连接池的目标大小limit在minsize和maxsize之间自动调整：底层连接池按maxsize创建，这里限制同时取出的连接数。
+    一个周期内有取连接等待超过POOL_GROW_WAIT_MS毫秒时，limit扩大一半；
+    连续POOL_SHRINK_AFTER秒同时使用的连接数都不到limit时，limit缩小到这段时间的峰值，并关闭多出来的空闲连接。
+    """
+
+    def __init__(self, pool, minsize, maxsize, limit):
+        self.pool = pool
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.limit = limit
+        self.in_use = 0
+        self.peak = 0  # 本周期内同时使用的连接数的峰值
+        self.slow_waits = 0  # 本周期内等待超过POOL_GROW_WAIT_MS的次数
+        self.quiet = 0  # 已经连续多少秒用不满
+        self.quiet_peak = 0
+        self._waiters = collections.deque()
+        self._last_used = weakref.WeakKeyDictionary()  # {连接: 上次归还的时间}
+
+    async def warm_up(self, size):
+        """ 同时取出size个连接再归还，让它们留在连接池中 """
+        n = min(size, self.maxsize)
+        if n <= self.pool.size:
+            return
+        conns = await asyncio.gather(*[self.pool.acquire() for _ in range(n)], return_exceptions=True)
+        for conn in conns:
+            if isinstance(conn, BaseException):
+                logging.warning('failed to warm up connection: %s' % conn)
+            else:
+                self.pool.release(conn)
+                self._last_used[conn] = time.time()
+        logging.info('warmed up %s: %s connections' % (stats_of(self.pool).name, self.pool.size))
+
+    async def acquire(self):
+        start = time.perf_counter()
+        while self.in_use >= self.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except BaseException:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                elif waiter.done() and not waiter.cancelled():
+                    # 已被唤醒却不再需要，把名额让给下一个
+                    self._wake()
+                raise
+        self.in_use += 1
+        self.peak = max(self.peak, self.in_use)
+        try:
+            conn = await self._checkout()
+        except BaseException:
+            self.in_use -= 1
+            self._wake()
+            raise
+        if (time.perf_counter() - start) * 1000 > POOL_GROW_WAIT_MS:
+            self.slow_waits += 1
+        return conn
+
+    async def _checkout(self):
+        while True:
+            conn = await self.pool.acquire()
+            last_used = self._last_used.pop(conn, None)
+            if last_used is None or time.time() - last_used < POOL_PING_IDLE:
+                return conn
+            try:
+                await conn.ping()
+                return conn
+            except Exception as e:
+                logging.warning('discarding dead connection of %s: %s' % (stats_of(self.pool).name, e))
+                conn.close()
+                self.pool.release(conn)
+
+    def release(self, conn):
+        self.pool.release(conn)
+        if not conn.closed:
+            self._last_used[conn] = time.time()
+        self.in_use -= 1
+        self._wake()
+
+    def _wake(self):
+        free = self.limit - self.in_use
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    async def resize(self):
+        name = stats_of(self.pool).name
+        # 还在排队的也算慢的取连接，否则连接都被长期占用时永远不会扩大
+        self.slow_waits += len(self._waiters)
+        if self.slow_waits and self.limit < self.maxsize:
+            self.limit = min(self.maxsize, self.limit + max(1, self.limit // 2))
+            logging.info('growing pool %s to %s (%s slow checkouts)' % (name, self.limit, self.slow_waits))
+            self.quiet = self.quiet_peak = 0
+            self._wake()
+        elif not self.slow_waits and self.peak < self.limit:
+            self.quiet += POOL_RESIZE_INTERVAL
+            self.quiet_peak = max(self.quiet_peak, self.peak)
+            if self.quiet >= POOL_SHRINK_AFTER and self.limit > self.minsize:
+                self.limit = max(self.minsize, self.quiet_peak)
+                logging.info('shrinking pool %s to %s' % (name, self.limit))
+                self.quiet = self.quiet_peak = 0
+        else:
+            self.quiet = self.quiet_peak = 0
+        self.peak = self.in_use
+        self.slow_waits = 0
+        # 关闭超出目标大小的空闲连接
+        while self.pool.size > self.limit and self.pool.freesize > 0:
+            conn = await self.pool.acquire()
+            conn.close()
+            self.pool.release(conn)
+
+
+# {连接池: PoolSizer}
+_pool_sizers = dict()
+_resizer = None
+
+
+async def _start_sizing(pool, kwargs):
+    minsize = kwargs.get('minsize', 1)
+    maxsize = kwargs.get('maxsize', 10)
+    warmup = kwargs.get('warmup', minsize)
+    sizer = _pool_sizers[pool] = PoolSizer(pool, minsize, maxsize, max(minsize, min(warmup, maxsize)))
+    await sizer.warm_up(warmup)
+
+
+async def _resize_pools():
+    while True:
+        await asyncio.sleep(POOL_RESIZE_INTERVAL)
+        for sizer in list(_pool_sizers.values()):
+            try:
+                await sizer.resize()
+            except Exception as e:
+                logging.warning('failed to resize pool: %s' % e)
+
+
+class QueryRecorder(object):
+    """
+    记录每条select/execute的耗时：按语句形状（合并空白后的SQL）统计耗时分布，
+    按sample_rate抽样保存普通查询，超过slow_ms毫秒的查询全部保存，连同参数和EXPLAIN的结果。
+    保存的记录会通过/api/metrics返回：写入语句和涉及REDACTED_TABLES的查询不保存参数（可能是密码摘要、email等）。
+    """
+
+    MAX_SHAPES = 500
+    MAX_ARG_LENGTH = 200
+    REDACTED_TABLES = frozenset(['users'])
+
+    def __init__(self, slow_ms=200, sample_rate=0.01, keep=100):
+        self.slow_ms = slow_ms
+        self.sample_rate = sample_rate
+        self.shapes = dict()  # {SQL: Histogram}
+        self.slow = collections.deque(maxlen=keep)
+        self.samples = collections.deque(maxlen=keep)
+
+    def record(self, pool, sql, args, ms, rows):
+        shape = normalize_sql(sql)[0]
+        histogram = self.shapes.get(shape)
+        if histogram is None:
+            # 语句形状太多时（如拼接了参数的SQL）并入同一项，避免无限增长
+            if len(self.shapes) >= self.MAX_SHAPES:
+                shape = '<other>'
+            histogram = self.shapes.setdefault(shape, Histogram())
+        histogram.observe(ms)
+        timing = _timing.get()
+        if timing is not None:
+            timing.observe(ms)
+        logging.debug('SQL: %s (%.1f ms, %s rows)', shape, ms, rows)
+        if ms >= self.slow_ms:
+            entry = self._entry(pool, shape, args, ms, rows)
+            self.slow.append(entry)
+            logging.warning('slow query (%.1f ms): %s' % (ms, shape))
+            if shape.lower().startswith('select'):
+                # 在空的上下文中执行，不占用调用方的事务连接
+                asyncio.get_running_loop().call_soon(
+                    lambda: asyncio.ensure_future(self._explain(pool, sql, args, entry)), context=contextvars.Context())
+        elif self.sample_rate and random.random() < self.sample_rate:
+            self.samples.append(self._entry(pool, shape, args, ms, rows))
+
+    def _entry(self, pool, shape, args, ms, rows):
+        if not shape.lower().startswith('select') or normalize_sql(shape)[1] & self.REDACTED_TABLES:
+            args = '<redacted>' if args else []
+        else:
+            args = [a[:self.MAX_ARG_LENGTH] if isinstance(a, str) else a for a in (args or ())]
+        return dict(sql=shape, args=args, ms=round(ms, 3), rows=rows, pool=stats_of(pool).name, at=time.time())
+
+    async def _explain(self, pool, sql, args, entry):
+        try:
+            async with acquire(pool) as conn:
+                async with conn.cursor(_backend.cursor_class()) as cur:
+                    await cur.execute(_backend.explain + _backend.translate(sql), args or ())
+                    entry['explain'] = await cur.fetchall()
+        except Exception as e:
+            entry['explain'] = 'failed: %s' % e
+
+    def snapshot(self, top=50):
+        """ 按总耗时取前top个语句形状 """
+        shapes = sorted(self.shapes.items(), key=lambda item: item[1].total, reverse=True)[:top]
+        return dict(slow_ms=self.slow_ms, sample_rate=self.sample_rate,
+                    shapes=[dict(sql=sql, ms=h.snapshot()) for sql, h in shapes],
+                    slow=list(self.slow), samples=list(self.samples))
+
+
+_recorder = QueryRecorder()
+
+
+def configure_recorder(slow_ms=200, sample_rate=0.01, keep=100):
+    global _recorder
+    _recorder = QueryRecorder(slow_ms, sample_rate, keep)
+    return _recorder
+
+
+def query_stats(top=50):
+    """ 查询记录的快照：各语句形状的耗时分布、慢查询和抽样 """
+    return _recorder.snapshot(top)
+
+
+class PinnedConnection(object):
+    """ 被事务固定的连接；同一时刻只允许一个查询使用（块内用gather并发查询时按顺序执行） """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = asyncio.Lock()
+        self.tables = set()  # 事务中写过的表，提交或回滚后再次清除它们的查询缓存
+        self.counts = dict()  # {RowCount: 行数变化}，提交后才计入
+        self.stale_counts = set()  # 提交后需要重新查询的RowCount
+
+
+# 当前上下文固定使用的连接（PinnedConnection），为None时每次查询从连接池取连接
+_pinned = contextvars.ContextVar('orm_pinned_connection', default=None)
+
+# 是否让每个请求固定使用一个主库连接（见RequestConnection），由create_pool按配置设置
+PIN_REQUEST_CONNECTION = False
+
+
+class RequestConnection(object):
+    """
+    一个请求固定使用的主库连接：第一次用到时才从连接池取出，之后请求中的select/execute都复用它，
+    request_scope()退出时归还。本请求的其他协程（如gather()中的加载）正在用这个连接时排队等待，
+    不另取连接：连接池被各请求固定的连接占满时，另取连接的请求会互相等待下去。
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.conn = None
+        self.acquired = None
+        self.lock = asyncio.Lock()
+        self.closed = False
+
+    async def get(self):
+        if self.conn is not None and self.conn.closed:
+            # 连接因超时等原因被关闭了，换一个
+            self.checkin()
+        if self.conn is None:
+            self.conn, self.acquired = await checkout(self.pool)
+        return self.conn
+
+    def checkin(self):
+        conn, self.conn = self.conn, None
+        if conn is not None:
+            checkin(self.pool, conn, self.acquired)
+
+    def release(self):
+        """ 请求结束；连接还在使用时由使用者用完后归还 """
+        self.closed = True
+        if not self.lock.locked():
+            self.checkin()
+
+
+# 当前请求的RequestConnection
+_request_conn = contextvars.ContextVar('orm_request_connection', default=None)
+
+
+@contextlib.asynccontextmanager
+async def connection(pool):
+    """ 有固定连接时使用固定连接（事务的连接优先于请求的连接），否则从pool取连接 """
+    pinned = _pinned.get()
+    if pinned is not None:
+        async with pinned.lock:
+            yield pinned.conn
+        return
+    holder = _request_conn.get()
+    if holder is not None and holder.pool is pool and not holder.closed:
+        async with holder.lock:
+            conn = await holder.get()
+            try:
+                yield conn
+            finally:
+                if holder.closed:
+                    holder.checkin()
+        return
+    async with acquire(pool) as conn:
+        yield conn
+
+
+@contextlib.asynccontextmanager
+async def transaction():
+    """
+    在一个主库连接上执行的事务：
+
+        async with orm.transaction():
+            await comment.save()
+            await orm.execute('update `blogs` set ...', [...])
+
+    块内所有select/execute/Model操作都使用同一个连接，正常退出时提交，抛出异常时回滚。
+    回滚后清空请求级身份映射，避免其中留下未提交的数据。嵌套调用会加入外层事务。
+    """
+    if _pinned.get() is not None:
+        yield
+        return
+    # 请求固定了连接时在这个连接上执行事务
+    async with connection(__pool) as conn:
+        pinned = PinnedConnection(conn)
+        token = _pinned.set(pinned)
+        try:
+            await conn.begin()
+            try:
+                yield
+            except BaseException:
+                # 超时的语句会关闭连接，事务已经由数据库回滚
+                if not conn.closed:
+                    await conn.rollback()
+                identity = _identity.get()
+                if identity is not None:
+                    identity.clear()
+                raise
+            await conn.commit()
+            for counter, delta in pinned.counts.items():
+                counter._apply(delta)
+            for counter in pinned.stale_counts:
+                counter.reconciled_at = 0
+        finally:
+            _pinned.reset(token)
+            # 事务进行期间其他请求可能把旧数据放进了缓存
+            if _query_cache is not None:
+                for table in pinned.tables:
+                    _query_cache.invalidate(table)
+
+
+# 单条语句的默认超时（秒）和每个请求中所有语句的总时限（秒），None表示不限制；由create_pool按配置设置
+QUERY_TIMEOUT = None
+REQUEST_TIMEOUT = None
+
+# 当前请求的截止时间（time.monotonic()），见deadline()
+_deadline = contextvars.ContextVar('orm_deadline', default=None)
+
+
+class QueryTimeout(Exception):
+    """ 语句超过了timeout或请求的截止时间，已在数据库中止并丢弃了连接 """
+    pass
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """ 块内的所有语句必须在seconds秒内完成；嵌套时取较早的截止时间 """
+    at = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(at if current is None else min(at, current))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def statement_timeout(timeout=None):
+    """ 本条语句可用的秒数：timeout（默认QUERY_TIMEOUT）与请求剩余时间中较小的一个 """
+    if timeout is None:
+        timeout = QUERY_TIMEOUT
+    at = _deadline.get()
+    if at is not None:
+        remaining = at - time.monotonic()
+        if remaining <= 0:
+            raise QueryTimeout('request deadline exceeded')
+        timeout = remaining if timeout is None else min(timeout, remaining)
+    return timeout
+
+
+async def run_with_timeout(pool, conn, coro, timeout):
+    """ 在timeout秒内执行coro；超时后在数据库中止正在执行的语句，并关闭连接（归还时连接池会丢弃它） """
+    if timeout is None:
+        return await coro
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        logging.warning('query on %s timed out after %.3fs, killing it' % (stats_of(pool).name, timeout))
+        try:
+            await asyncio.wait_for(_backend.kill(pool, conn), 2)
+        except Exception as e:
+            logging.warning('failed to kill query: %s' % e)
+        conn.close()
+        raise QueryTimeout('query timed out after %.3fs' % timeout)
+
+
+async def _select(pool, sql, args, size, cursor_class, timeout):
+    async def run(conn):
+        cur = await conn.cursor(cursor_class)
+        await cur.execute(_backend.translate(sql), args or ())
         if size:
             rs = await cur.fetchmany(size)
         else:
             rs = await cur.fetchall()
         await cur.close()
-        logging.info('rows returned: %s' % len(rs))
         return rs
 
+    timeout = statement_timeout(timeout)
+    async with connection(pool) as conn:
+        start = time.perf_counter()
+        rs = await run_with_timeout(pool, conn, run(conn), timeout)
+        ms = (time.perf_counter() - start) * 1000
+        stats_of(pool).query.observe(ms)
+        _recorder.record(pool, sql, args, ms, len(rs))
+        return rs
+
+
+async def select(sql, args, size=None, primary=False, tuples=False, timeout=None):
+    """
+    读请求分配到从库，从库连接出错时标记为不可用并改在主库重试；primary=True或在事务中时读主库。
+    默认每行返回dict，tuples=True时返回tuple，省去为每行创建dict（Model按列顺序直接从tuple构造）。
+    开启查询缓存后，除primary=True、事务中和当前请求写过主库之后的查询外，结果按(SQL, 参数)缓存。
+    超过timeout秒（默认QUERY_TIMEOUT，且不超过请求的截止时间）时中止查询并抛出QueryTimeout。
+    """
+    cache = _query_cache
+    # 写过主库后要读到自己写的数据，不能用别的请求从（可能有延迟的）从库读出放进缓存的结果
+    if cache is not None and not primary and _pinned.get() is None and not _wrote_primary.get():
+        key = cache.key(sql, args, size, tuples)
+        if key is not None:
+            rs = cache.get(key)
+            if rs is not None:
+                return list(rs)
+            generation = cache.generation()
+            rs = await _select_routed(sql, args, size, primary, tuples, timeout)
+            cache.put(key, rs, generation)
+            return list(rs)
+    return await _select_routed(sql, args, size, primary, tuples, timeout)
 
-async def execute(sql, args, autocommit=True):
-    log(sql)
-    async with __pool.get() as conn:
+
+async def _select_routed(sql, args, size, primary, tuples, timeout=None):
+    cursor_class = _backend.cursor_class(tuples)
+    replica = None if primary or _pinned.get() is not None else choose_replica()
+    if replica is not None:
+        replica.inflight += 1
+        try:
+            return await _select(replica.pool, sql, args, size, cursor_class, timeout)
+        except _backend.disconnect_errors as e:
+            replica.mark_down(e)
+        finally:
+            replica.inflight -= 1
+    return await _select(__pool, sql, args, size, cursor_class, timeout)
+
+
+async def select_stream(sql, args, chunk_size=1000, tuples=False, timeout=None):
+    """
+    使用服务端游标（SSDictCursor，tuples=True时为SSCursor）逐块读取结果，每次yield不超过chunk_size行，
+    结果集不会一次性加载进内存。调用方提前退出时，未读完的结果集还占着连接，
+    直接关闭连接比读完剩余的行更快，连接池会丢弃已关闭的连接。
+    在事务中时，事务的连接同一时刻只能执行一个查询，而循环体中常常还要查询（如边遍历边update），
+    所以先用普通游标读出全部结果、放开连接后再分块返回，这时结果集会全部加载进内存。
+    sqlite后端的游标本来就是逐行读取的。timeout限制执行语句和读取每一块的时间。
+    """
+    if _pinned.get() is not None:
+        rs = await select(sql, args, tuples=tuples, timeout=timeout)
+        for start in range(0, len(rs), chunk_size):
+            yield rs[start:start + chunk_size]
+        return
+    replica = choose_replica()
+    pool = replica.pool if replica is not None else __pool
+    # 不使用请求固定的连接：迭代期间循环体中的查询还要用它
+    async with acquire(pool) as conn:
+        finished = False
+        cur = await conn.cursor(_backend.cursor_class(tuples, stream=True))
+        try:
+            start = time.perf_counter()
+            await run_with_timeout(pool, conn, cur.execute(_backend.translate(sql), args or ()), statement_timeout(timeout))
+            # 只计到服务端开始返回结果为止，不含调用方处理每块的时间
+            ms = (time.perf_counter() - start) * 1000
+            stats_of(pool).query.observe(ms)
+            _recorder.record(pool, sql, args, ms, None)
+            while True:
+                rs = await run_with_timeout(pool, conn, cur.fetchmany(chunk_size), statement_timeout(timeout))
+                if not rs:
+                    break
+                yield rs
+            finished = True
+            await cur.close()
+        finally:
+            if not finished and not conn.closed:
+                conn.close()
+
+
+# MySQL错误码：唯一键重复
+ER_DUP_ENTRY = 1062
+
+
+class DuplicateKeyError(Exception):
+    """ 写入违反了主键或唯一索引 """
+    pass
+
+
+async def execute(sql, args, autocommit=True, timeout=None):
+    """ 超过timeout秒（默认QUERY_TIMEOUT，且不超过请求的截止时间）时中止语句并抛出QueryTimeout """
+    timeout = statement_timeout(timeout)
+    _wrote_primary.set(True)
+    pinned = _pinned.get()
+    table = written_table(sql)
+    if pinned is not None:
+        pinned.tables.add(table)
+    # 在transaction()中时由事务统一提交
+    autocommit = autocommit or pinned is not None
+    async with connection(__pool) as conn:
         if not autocommit:
             await conn.begin()
-        try:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql.replace('?', '%s'), args or ())
+        async def run():
+            async with conn.cursor(_backend.cursor_class()) as cur:
+                await cur.execute(_backend.translate(sql), args or ())
                 affected = cur.rowcount
             if not autocommit:
                 await conn.commit()
+            return affected
+
+        try:
+            start = time.perf_counter()
+            affected = await run_with_timeout(__pool, conn, run(), timeout)
+            ms = (time.perf_counter() - start) * 1000
+            stats_of(__pool).query.observe(ms)
+            _recorder.record(__pool, sql, args, ms, affected)
         except BaseException as e:
-            if not autocommit:
+            if not autocommit and not conn.closed:
                 await conn.rollback()
+            if _backend.is_duplicate_key(e):
+                raise DuplicateKeyError(*e.args) from e
             raise e
+        finally:
+            # 写完（或失败）之后再删除缓存，写入期间放进缓存的旧数据也一并删除
+            if _query_cache is not None:
+                _query_cache.invalidate(table)
         return affected
 
 
+_RE_TABLES = re.compile(r'\b(?:from|join)\s+`?(\w+)`?', re.IGNORECASE)
+_RE_WRITTEN = re.compile(r'^\s*(?:insert\s+(?:ignore\s+)?into|replace\s+into|update|delete\s+from)\s+`?(\w+)`?', re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=512)
+def normalize_sql(sql):
+    """ 返回(合并空白后的SQL, 查询涉及的表) """
+    return ' '.join(sql.split()), frozenset(t.lower() for t in _RE_TABLES.findall(sql))
+
+
+@functools.lru_cache(maxsize=512)
+def written_table(sql):
+    m = _RE_WRITTEN.match(sql)
+    return m.group(1).lower() if m else None
+
+
+class QueryCache(object):
+    """
+    select()的结果缓存：LRU淘汰，最多maxsize条，每条ttl秒后过期。
+    execute()写完一张表后，删除所有涉及这张表的缓存；无法识别写入的表时清空全部缓存。
+    每次删除都推进一个计数器：查询开始前取generation()，结果放回缓存时如果涉及的表在这之后被写过就不放，
+    避免和写入同时进行的查询把写入前的旧数据放回缓存。
+    """
+
+    def __init__(self, maxsize=1000, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()  # {key: (过期时间, 涉及的表, 结果)}
+        self._by_table = collections.defaultdict(set)  # {表: set(key)}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.rejected = 0  # 因为查询期间表被写过而没有放入的结果
+        self._clock = 0
+        self._written = dict()  # {表: 最后一次删除缓存时的_clock}
+        self._written_all = 0  # 最后一次清空缓存时的_clock
+
+    def key(self, sql, args, size, tuples):
+        """ 参数不可哈希时返回None，不缓存 """
+        normalized, tables = normalize_sql(sql)
+        try:
+            key = (normalized, tuple(args or ()), size, tuples)
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.time():
+            if entry is not None:
+                self._drop(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[2]
+
+    def generation(self):
+        """ 在查询前调用，结果传给put() """
+        return self._clock
+
+    def put(self, key, rs, generation):
+        tables = normalize_sql(key[0])[1]
+        if self._written_all > generation or any(self._written.get(t, 0) > generation for t in tables):
+            self.rejected += 1
+            return
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (time.time() + self.ttl, tables, rs)
+        for t in tables:
+            self._by_table[t].add(key)
+        while len(self._entries) > self.maxsize:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            for t in entry[1]:
+                keys = self._by_table.get(t)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self._by_table[t]
+
+    def invalidate(self, table=None):
+        """ 删除涉及table的缓存，table为None时清空 """
+        self.invalidations += 1
+        self._clock += 1
+        if table is None:
+            self._written_all = self._clock
+            self._entries.clear()
+            self._by_table.clear()
+            return
+        self._written[table] = self._clock
+        for key in list(self._by_table.get(table, ())):
+            self._drop(key)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(size=len(self._entries), maxsize=self.maxsize, ttl=self.ttl, hits=self.hits, misses=self.misses,
+                    hit_rate=round(self.hits / total, 4) if total else 0.0,
+                    evictions=self.evictions, invalidations=self.invalidations, rejected=self.rejected)
+
+
+_query_cache = None
+
+
+def enable_query_cache(maxsize=1000, ttl=30):
+    global _query_cache
+    logging.info('开启查询缓存: maxsize=%s, ttl=%ss' % (maxsize, ttl))
+    _query_cache = QueryCache(maxsize, ttl)
+    return _query_cache
+
+
+def disable_query_cache():
+    global _query_cache
+    _query_cache = None
+
+
+def cache_stats():
+    """ 查询缓存的命中、未命中等计数，未开启时返回None """
+    return _query_cache.stats() if _query_cache is not None else None
+
+
 def create_args_string(num):
     args = []
     for n in range(num):
@@ -75,14 +1080,756 @@ def create_args_string(num):
     return ', '.join(args)
 
 
+_RE_COUNT_ALL = re.compile(r'^\s*count\(\s*`?(\*|\w+)`?\s*\)\s*$', re.IGNORECASE)
+_RE_ORDER = re.compile(r'^\s*`?(\w+)`?(?:\s+(asc|desc))?\s*$', re.IGNORECASE)
+
+# 编译后的SQL语句缓存，键为(Model类, 查询形状)，同一形状的查询只拼接一次SQL。
+# 形状中可能有调用方拼接的where、in列表的长度等，所以和to_mysql()一样只保留最近用过的STATEMENT_CACHE_SIZE条
+STATEMENT_CACHE_SIZE = 512
+_statements = collections.OrderedDict()
+
+
+def cached_statement(key, build):
+    sql = _statements.get(key)
+    if sql is None:
+        sql = _statements[key] = build()
+        if len(_statements) > STATEMENT_CACHE_SIZE:
+            _statements.popitem(last=False)
+    else:
+        _statements.move_to_end(key)
+    return sql
+
+
+class Expr(object):
+    """ SQL表达式片段及其参数，可以用 & | ~ 组合 """
+
+    def __init__(self, sql, args=()):
+        self.sql = sql
+        self.args = list(args)
+
+    def __and__(self, other):
+        return Expr('(%s) and (%s)' % (self.sql, other.sql), self.args + other.args)
+
+    def __or__(self, other):
+        return Expr('(%s) or (%s)' % (self.sql, other.sql), self.args + other.args)
+
+    def __invert__(self):
+        return Expr('not (%s)' % self.sql, self.args)
+
+    def __str__(self):
+        return self.sql
+
+
+class Column(object):
+    """ 列表达式，如 Blog.column('created_at') > t 或 Blog.column('created_at').desc() """
+
+    def __init__(self, name):
+        self.name = name
+
+    def _compare(self, op, value):
+        return Expr('`%s`%s?' % (self.name, op), [value])
+
+    def __eq__(self, value):
+        if value is None:
+            return Expr('`%s` is null' % self.name)
+        return self._compare('=', value)
+
+    def __ne__(self, value):
+        if value is None:
+            return Expr('`%s` is not null' % self.name)
+        return self._compare('<>', value)
+
+    def __lt__(self, value):
+        return self._compare('<', value)
+
+    def __le__(self, value):
+        return self._compare('<=', value)
+
+    def __gt__(self, value):
+        return self._compare('>', value)
+
+    def __ge__(self, value):
+        return self._compare('>=', value)
+
+    __hash__ = object.__hash__
+
+    def in_(self, values):
+        values = list(values)
+        if not values:
+            return Expr('1=0')
+        return Expr('`%s` in (%s)' % (self.name, create_args_string(len(values))), values)
+
+    def like(self, pattern):
+        return self._compare(' like ', pattern)
+
+    def asc(self):
+        return Order(self.name)
+
+    def desc(self):
+        return Order(self.name, True)
+
+    def __str__(self):
+        return '`%s`' % self.name
+
+
+class Order(Expr):
+    """ 排序表达式，记住列名和方向，键集分页需要据此生成比较条件 """
+
+    def __init__(self, name, descending=False):
+        super(Order, self).__init__('`%s` %s' % (name, 'desc' if descending else 'asc'))
+        self.name = name
+        self.descending = descending
+
+    def reverse(self):
+        return Order(self.name, not self.descending)
+
+
+class Query(object):
+    """
+    查询构造器，每个方法都返回新的Query对象，因此可以在模块级别预先构造再复用：
+
+        q = Blog.query().order_by(Blog.column('created_at').desc(), Blog.column('id').desc())
+        blogs = await q.limit(10).offset(20).all()
+        blogs = await q.limit(10).after((created_at, id)).all()
+
+    SQL只依赖查询的形状（条件表达式、排序、是否有limit/offset、键集方向），不依赖参数值，
+    所以同一形状的SQL只会编译一次。
+
+    after()/before()是键集（seek）分页：用上一页最后（第一）行的排序列值作为边界，
+    不需要MySQL扫描并丢弃offset行，翻到多深的页都和第一页一样快。
+    排序列的组合必须唯一，通常在最后加上主键。
+    """
+
+    def __init__(self, model, where=None, orders=(), limit=None, offset=None, seek=None, columns=None):
+        self._model = model
+        self._where = where
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._offset = offset
+        self._seek = seek
+        self._columns = model.projection(columns)
+
+    def _copy(self, **kw):
+        q = Query(self._model, self._where, self._orders, self._limit, self._offset, self._seek, self._columns)
+        for k, v in kw.items():
+            setattr(q, '_' + k, v)
+        return q
+
+    def filter(self, *exprs):
+        where = self._where
+        for e in exprs:
+            where = e if where is None else where & e
+        return self._copy(where=where)
+
+    def order_by(self, *orders):
+        return self._copy(orders=self._orders + tuple(orders))
+
+    def limit(self, limit):
+        return self._copy(limit=limit)
+
+    def columns(self, *names):
+        """ 只查询指定的列（总是包含主键），其余列在返回的对象上未赋值 """
+        return self._copy(columns=self._model.projection(names))
+
+    def offset(self, offset):
+        return self._copy(offset=offset)
+
+    def after(self, values):
+        """ 排序方向上位于values之后的行 """
+        return self._seek_to('after', values)
+
+    def before(self, values):
+        """ 排序方向上位于values之前的行，结果仍按原排序返回 """
+        return self._seek_to('before', values)
+
+    def _seek_to(self, direction, values):
+        values = tuple(values)
+        if len(values) != len(self._orders) or not all(isinstance(o, Order) for o in self._orders):
+            raise ValueError('keyset bound %s does not match order by %s' % (str(values), ', '.join(map(str, self._orders))))
+        return self._copy(seek=(direction, values))
+
+    def _keyset(self):
+        """ 返回(条件Expr, 排序)。(a desc, b desc)之后的行即 a<? or (a=? and b<?)，before方向时排序反转 """
+        direction, values = self._seek
+        before = direction == 'before'
+        terms = []
+        for i, order in enumerate(self._orders):
+            op = '<' if order.descending != before else '>'
+            eqs = ['`%s`=?' % o.name for o in self._orders[:i]]
+            terms.append(Expr(' and '.join(eqs + ['`%s`%s?' % (order.name, op)]), values[:i + 1]))
+        cond = terms[0]
+        for t in terms[1:]:
+            cond = cond | t
+        orders = tuple(o.reverse() for o in self._orders) if before else self._orders
+        return cond, orders
+
+    def _parts(self):
+        where, orders = self._where, self._orders
+        if self._seek is not None:
+            cond, orders = self._keyset()
+            where = cond if where is None else where & cond
+        return where, orders
+
+    def _shape(self):
+        return (self._columns, self._where.sql if self._where is not None else None,
+                tuple(str(o) for o in self._orders),
+                self._limit is not None, self._offset is not None,
+                self._seek[0] if self._seek is not None else None)
+
+    def _args(self):
+        where = self._parts()[0]
+        args = list(where.args) if where is not None else []
+        if self._offset is not None:
+            args.append(self._offset)
+            # MySQL的offset必须和limit一起使用
+            args.append(self._limit if self._limit is not None else 9223372036854775807)
+        elif self._limit is not None:
+            args.append(self._limit)
+        return args
+
+    def _build(self, head):
+        where, orders = self._parts()
+        sql = [head]
+        if where is not None:
+            sql.append('where')
+            sql.append(where.sql)
+        if orders:
+            sql.append('order by')
+            sql.append(', '.join(map(str, orders)))
+        if self._offset is not None:
+            sql.append('limit ?, ?')
+        elif self._limit is not None:
+            sql.append('limit ?')
+        return ' '.join(sql)
+
+    def compile(self):
+        """ 返回(sql, args)，sql按(Model类, 查询形状)缓存 """
+        model = self._model
+        sql = cached_statement((model, 'query') + self._shape(), lambda: self._build(model.select_head(self._columns)))
+        return sql, self._args()
+
+    async def all(self):
+        sql, args = self.compile()
+        rs = await select(sql, args, tuples=True)
+        if self._seek is not None and self._seek[0] == 'before':
+            rs.reverse()
+        from_row = self._model.row_loader(self._columns)
+        return [from_row(r) for r in rs]
+
+    async def first(self):
+        rs = await self.limit(1).all()
+        return rs[0] if rs else None
+
+    async def page(self, page_index=1, page_size=10, after=None, before=None):
+        """
+        取第page_index页，有after/before游标（见pagination.Page）时按键集定位，返回(对象列表, Page)。
+        游标记录的是这个查询的排序列的值，所以返回的对象必须包含所有排序列；游标不合法时抛出ValueError。
+        没有过滤条件时总数来自内存中维护的行数；有过滤条件时总数和这一页在同一条语句中查出：
+        按offset翻页用count(*) over()（需要MySQL 8.0），按键集翻页用标量子查询（键集条件不能计入总数）。
+        """
+        bound_after = decode_cursor(after) if after else None
+        bound_before = decode_cursor(before) if before and bound_after is None else None
+        keyset = bound_after is not None or bound_before is not None
+        q = self.limit(page_size)
+        if bound_after is not None:
+            q = q.after(bound_after)
+        elif bound_before is not None:
+            q = q.before(bound_before)
+        if self._where is None:
+            total = await self.count()
+            p = Page(total, page_index, page_size, after, before)
+            if keyset:
+                items = await q.all()
+            elif p.limit:
+                items = await q.offset(p.offset).all()
+            else:
+                items = []
+        else:
+            if not keyset:
+                q = q.offset(page_size * (page_index - 1))
+            items, total = await q._all_with_total()
+            if total is None:
+                # 这一页没有行，无法从结果中得到总数
+                total = 0 if page_index == 1 and not keyset else await self.count()
+            p = Page(total, page_index, page_size, after, before)
+        p.set_cursors(items, lambda item: tuple(getattr(item, o.name) for o in self._orders))
+        return items, p
+
+    async def _all_with_total(self):
+        """ 返回(对象列表, 符合过滤条件的总行数)，没有行时总数为None """
+        model = self._model
+        table = model.__table__
+
+        def build():
+            head = ','.join(map(lambda f: '`%s`' % f, self._columns))
+            if self._seek is None:
+                return self._build('select %s, count(*) over() _total_ from `%s`' % (head, table))
+            return self._build('select %s, (select count(*) from `%s` where %s) _total_ from `%s`' % (head, table, self._where.sql, table))
+
+        sql = cached_statement((model, 'page') + self._shape(), build)
+        args = self._args() if self._seek is None else list(self._where.args) + self._args()
+        rs = await select(sql, args, tuples=True)
+        if self._seek is not None and self._seek[0] == 'before':
+            rs.reverse()
+        from_row = model.row_loader(self._columns)
+        return [from_row(r[:-1]) for r in rs], (rs[0][-1] if rs else None)
+
+    async def count(self):
+        """ 没有过滤条件时返回内存中维护的行数，不查询数据库 """
+        model = self._model
+        if self._where is None:
+            return await row_count(model).get()
+        q = self._copy(orders=(), limit=None, offset=None, seek=None, columns=model.__default_columns__)
+        sql = cached_statement((model, 'count') + q._shape(),
+                               lambda: q._build('select count(*) _num_ from `%s`' % model.__table__))
+        rs = await select(sql, q._args(), 1)
+        return rs[0]['_num_'] if rs else 0
+
+
+# 请求级的身份映射：{(Model类, 主键): 行tuple或None}，None表示已确认不存在
+_identity = contextvars.ContextVar('orm_identity_map', default=None)
+
+
+@contextlib.contextmanager
+def identity_map():
+    """
+    在with块内打开身份映射，同一主键的Model.find()只查询一次数据库，
+    之后从内存中的行数据构造新对象返回（不共享实例，修改返回的对象不会互相影响）。
+    save/update/remove会同步更新映射。已经打开时嵌套调用不会新建映射。
+    """
+    if _identity.get() is not None:
+        yield
+        return
+    token = _identity.set(dict())
+    try:
+        yield
+    finally:
+        _identity.reset(token)
+
+
+_in_request = contextvars.ContextVar('orm_in_request', default=False)
+
+
+@contextlib.contextmanager
+def request_scope():
+    """
+    一次HTTP请求的ORM作用域：打开身份映射，并清除写后读主库的标记，返回记录本次请求数据库耗时的RequestTiming。
+    配置了REQUEST_TIMEOUT时，请求中所有语句都要在这个时间内完成。
+    PIN_REQUEST_CONNECTION为True时，请求中的主库查询共用一个连接，退出时归还。
+    已经在作用域内时嵌套调用直接复用外层。
+    """
+    if _in_request.get():
+        yield _timing.get()
+        return
+    timing = RequestTiming()
+    tokens = [(_in_request, _in_request.set(True)), (_wrote_primary, _wrote_primary.set(False)),
+              (_timing, _timing.set(timing)), (_fanout_slots, _fanout_slots.set(asyncio.Semaphore(FANOUT_LIMIT)))]
+    if REQUEST_TIMEOUT is not None:
+        tokens.append((_deadline, _deadline.set(time.monotonic() + REQUEST_TIMEOUT)))
+    holder = RequestConnection(__pool) if PIN_REQUEST_CONNECTION and __pool is not None else None
+    if holder is not None:
+        tokens.append((_request_conn, _request_conn.set(holder)))
+    try:
+        with identity_map():
+            yield timing
+    finally:
+        if holder is not None:
+            holder.release()
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+class RequestTiming(object):
+    """
+    一次请求的数据库耗时。并发执行的查询各自计入db_ms，所以db_ms可能大于请求的总时间；
+    fanout_ms是gather()等待的墙钟时间，两者对比可以看出并发省下了多少。
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_ms = 0.0
+        self.fanouts = 0
+        self.fanout_ms = 0.0
+
+    def observe(self, ms):
+        self.queries += 1
+        self.db_ms += ms
+
+    @property
+    def total_ms(self):
+        return (time.perf_counter() - self.start) * 1000
+
+    def server_timing(self):
+        """ Server-Timing响应头的值 """
+        return 'db;dur=%.1f;desc="%s queries", fanout;dur=%.1f;desc="%s fan-outs", total;dur=%.1f' % (
+            self.db_ms, self.queries, self.fanout_ms, self.fanouts, self.total_ms)
+
+    def __str__(self):
+        return '%.1f ms (db %.1f ms in %s queries, fan-out %.1f ms in %s)' % (
+            self.total_ms, self.db_ms, self.queries, self.fanout_ms, self.fanouts)
+
+
+# 当前请求的RequestTiming
+_timing = contextvars.ContextVar('orm_request_timing', default=None)
+
+# 一个请求中gather()同时执行的加载数上限，避免一个页面占满连接池；由create_pool按配置设置
+FANOUT_LIMIT = 4
+_fanout_slots = contextvars.ContextVar('orm_fanout_slots', default=None)
+_in_fanout = contextvars.ContextVar('orm_in_fanout', default=False)
+
+
+async def gather(*aws):
+    """
+    并发执行互不依赖的加载，如 blog, comments = await gather(Blog.find(id), Comment.findall(...))，
+    按参数顺序返回结果。每个加载在自己的任务中执行，不在事务中时各自从连接池取连接
+    （PIN_REQUEST_CONNECTION时共用请求的连接，查询依次执行）；
+    同一请求中同时执行的加载不超过FANOUT_LIMIT个。已经在gather()的加载中时按顺序执行，避免嵌套占满名额。
+    有一个加载出错时取消其余的加载，等它们归还连接后再抛出异常。
+    """
+    if _in_fanout.get():
+        return [await aw for aw in aws]
+    slots = _fanout_slots.get() or asyncio.Semaphore(FANOUT_LIMIT)
+    wrote = []
+
+    async def run(aw):
+        async with slots:
+            _in_fanout.set(True)
+            try:
+                return await aw
+            finally:
+                # 任务在上下文副本中执行，写过主库的标记要带回调用方
+                if _wrote_primary.get():
+                    wrote.append(True)
+
+    start = time.perf_counter()
+    tasks = [asyncio.ensure_future(run(aw)) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        if wrote:
+            _wrote_primary.set(True)
+        timing = _timing.get()
+        if timing is not None:
+            timing.fanouts += 1
+            timing.fanout_ms += (time.perf_counter() - start) * 1000
+
+
+# {Model类: BatchLoader}
+_batch_loaders = dict()
+
+
+class BatchLoader(object):
+    """
+    收集同一轮事件循环中对一个Model的主键查询，下一轮用一条_find_rows()查询，再把结果分发给各个等待者。
+    分发的是行tuple，每个调用方各自构造对象，不会共享实例。
+    查询在空的上下文中执行，不会把结果写进某一个请求的身份映射。
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self._pending = dict()  # {主键: [future]}
+
+    async def load(self, pk):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if not self._pending:
+            loop.call_soon(self._dispatch, context=contextvars.Context())
+        self._pending.setdefault(pk, []).append(future)
+        return await future
+
+    def _dispatch(self):
+        pending, self._pending = self._pending, dict()
+        asyncio.ensure_future(self._run(pending))
+
+    async def _run(self, pending):
+        try:
+            rows = await self.model._find_rows(list(pending))
+        except Exception as e:
+            for futures in pending.values():
+                for f in futures:
+                    if not f.done():
+                        f.set_exception(e)
+            return
+        logging.debug('batched %s lookups of %s into one query' % (sum(map(len, pending.values())), self.model.__name__))
+        for pk, futures in pending.items():
+            for f in futures:
+                if not f.done():
+                    f.set_result(rows.get(pk))
+
+
+# 维护的行数每隔多少秒与数据库核对一次
+COUNT_RECONCILE_INTERVAL = 60
+
+# {Model类: RowCount}
+_row_counts = dict()
+
+
+class RowCount(object):
+    """
+    在内存中维护的表行数，代替每次请求都执行的count(*)。
+    Model.save()/remove()等写入成功后增减；第一次读取时查询数据库，
+    之后超过COUNT_RECONCILE_INTERVAL秒的读取直接返回当前值，同时在后台重新查询一次，
+    纠正其他进程或直接执行SQL造成的偏差。
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.value = None
+        self.reconciled_at = 0
+        self._reconciling = None
+        self._inflight = 0  # 重新查询期间计入的增减
+
+    def add(self, delta):
+        """ 在事务中时，提交后才计入 """
+        pinned = _pinned.get()
+        if pinned is not None:
+            pinned.counts[self] = pinned.counts.get(self, 0) + delta
+        else:
+            self._apply(delta)
+
+    def _apply(self, delta):
+        if self._reconciling is not None:
+            # 查询结果可能不包含这些增减，查询完成后加上
+            self._inflight += delta
+        if self.value is not None:
+            self.value = max(self.value + delta, 0)
+
+    def stale(self):
+        """ 行数的变化无法确定时调用：下次读取时在后台重新查询。在事务中时，提交后才生效 """
+        pinned = _pinned.get()
+        if pinned is not None:
+            pinned.stale_counts.add(self)
+        else:
+            self.reconciled_at = 0
+
+    async def get(self):
+        if time.time() - self.reconciled_at > COUNT_RECONCILE_INTERVAL and self._reconciling is None:
+            self._inflight = 0
+            self._reconciling = asyncio.ensure_future(self._reconcile())
+        if self.value is None:
+            # 第一次读取，并发的调用方等待同一次查询
+            await asyncio.shield(self._reconciling)
+        return self.value
+
+    async def _reconcile(self):
+        model = self.model
+        sql = cached_statement((model, 'row_count'), lambda: 'select count(*) _num_ from `%s`' % model.__table__)
+        # 任务有自己的上下文副本：不使用调用方的事务连接和请求连接，读主库且不经过查询缓存
+        _pinned.set(None)
+        _request_conn.set(None)
+        try:
+            rs = await _select_routed(sql, None, 1, True, False)
+        except Exception as e:
+            if self.value is None:
+                raise
+            logging.warning('failed to reconcile row count of %s: %s' % (model.__table__, e))
+            return
+        finally:
+            self._reconciling = None
+        value = max((rs[0]['_num_'] if rs else 0) + self._inflight, 0)
+        if self.value is not None and self.value != value:
+            logging.info('row count of %s drifted: %s -> %s' % (model.__table__, self.value, value))
+        self.value = value
+        self.reconciled_at = time.time()
+
+
+def row_count(model):
+    counter = _row_counts.get(model)
+    if counter is None:
+        counter = _row_counts[model] = RowCount(model)
+    return counter
+
+
+# 写入失败（连接断开、超时）后重试前等待的秒数
+WRITE_BEHIND_RETRY = 1
+# 关闭时等待写后队列写完的秒数，超过后放弃剩下的对象
+WRITE_BEHIND_CLOSE_TIMEOUT = 10
+
+
+class WriteBehind(object):
+    """
+    一个Model的写后队列：Model.save_later()把对象放进内存就返回，后台任务攒够batch_size个或等interval秒后
+    用一条多行INSERT写入一批。队列中（含正在写入的）最多maxsize个对象，满了以后save_later()等待空位。
+    写入前其他请求读不到这些对象；作者的请求先调用sync(owner)，等自己的对象写完再读。
+    连接断开或超时时整批重试；其他错误时逐个插入，写不进去的对象记录日志后丢弃。
+    """
+
+    def __init__(self, model, batch_size=100, interval=0.05, maxsize=10000):
+        self.model = model
+        self.batch_size = batch_size
+        self.interval = interval
+        self.maxsize = maxsize
+        self.items = collections.deque()  # [(对象, owner)]
+        self.pending = collections.Counter()  # {owner: 还没写入的对象数}
+        self.enqueued = 0
+        self.done = 0  # 已写入或丢弃的对象数
+        self.dropped = 0
+        self.closed = False
+        self._space = asyncio.Semaphore(maxsize)
+        self._wakeup = asyncio.Event()  # 队列中有对象
+        self._hurry = asyncio.Event()  # 够一批了或有人在等，不必再等interval
+        self._flush_to = 0  # sync()/flush()等待写完的enqueued
+        self._writing = []  # 正在写入的一批
+        self._progress = asyncio.Condition()
+        self._flusher = None
+
+    async def put(self, obj, owner=None):
+        # 入队时就取默认值（主键、created_at等），返回给调用方的对象和稍后写入的一致
+        for key in self.model.__mappings__:
+            obj.getvalue_or_default(key)
+        if self._space.locked():
+            # 队列已满，要等后台写入腾出空间，而后台写入要从连接池取连接：
+            # 先把本请求固定的空闲连接还回去，否则连接池被等待的请求占满时谁也等不到
+            holder = _request_conn.get()
+            if holder is not None and not holder.lock.locked():
+                holder.checkin()
+        deadline = _deadline.get()
+        if deadline is None:
+            await self._space.acquire()
+        else:
+            try:
+                await asyncio.wait_for(self._space.acquire(), max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                raise QueryTimeout('timed out waiting for space in the write-behind queue of %s' % self.model.__table__)
+        self.items.append((obj, owner))
+        self.enqueued += 1
+        self.pending[owner] += 1
+        self._wakeup.set()
+        if len(self.items) >= self.batch_size:
+            self._hurry.set()
+        if self._flusher is None:
+            # 在空的上下文中创建，不使用当前请求的事务连接、请求连接和截止时间
+            self._flusher = contextvars.Context().run(asyncio.ensure_future, self._run())
+
+    async def _run(self):
+        while True:
+            while not self.items:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            if len(self.items) < self.batch_size and self._flush_to <= self.done and not self.closed:
+                try:
+                    await asyncio.wait_for(self._hurry.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._hurry.clear()
+            batch = [self.items.popleft() for _ in range(min(self.batch_size, len(self.items)))]
+            self._writing = batch
+            await self._write(batch)
+            self._writing = []
+
+    async def _write(self, batch):
+        objects = [obj for obj, owner in batch]
+        while True:
+            try:
+                await self.model.save_many(objects, self.batch_size)
+                break
+            except (QueryTimeout,) + _backend.disconnect_errors as e:
+                logging.warning('write-behind of %s failed, retrying: %s' % (self.model.__table__, e))
+                await asyncio.sleep(WRITE_BEHIND_RETRY)
+            except Exception as e:
+                # 多半是其中某一行违反了约束（如重试时已经写入过），逐个插入，只丢弃写不进去的
+                logging.warning('write-behind batch of %s failed, inserting one by one: %s' % (self.model.__table__, e))
+                for obj in objects:
+                    try:
+                        await obj.save()
+                    except Exception as e:
+                        self.dropped += 1
+                        logging.error('write-behind dropped %r: %s' % (obj, e))
+                break
+        for obj, owner in batch:
+            self.pending[owner] -= 1
+            if not self.pending[owner]:
+                del self.pending[owner]
+            self._space.release()
+        self.done += len(batch)
+        async with self._progress:
+            self._progress.notify_all()
+
+    async def flush(self):
+        """ 等到调用前入队的对象都写入（或丢弃） """
+        target = self.enqueued
+        if self.done >= target:
+            return
+        self._flush_to = max(self._flush_to, target)
+        self._hurry.set()
+        async with self._progress:
+            await self._progress.wait_for(lambda: self.done >= target)
+
+    async def sync(self, owner):
+        """ owner有还没写入的对象时等它们写完，这样owner能读到自己刚写的数据 """
+        if self.pending.get(owner):
+            await self.flush()
+
+    async def close(self, timeout=None):
+        """
+        不再接受新对象（之后的save_later()直接写入），写完队列中的对象后停止后台任务。
+        timeout秒内没有写完（如数据库不可用）时放弃剩下的对象，逐个记录到错误日志。
+        """
+        self.closed = True
+        try:
+            await asyncio.wait_for(self.flush(), timeout)
+        except asyncio.TimeoutError:
+            lost = list(self._writing) + list(self.items)
+            logging.error('write-behind of %s gave up %s objects on close after %ss'
+                          % (self.model.__table__, len(lost), timeout))
+            for obj, owner in lost:
+                logging.error('write-behind dropped %r' % obj)
+            self.dropped += len(lost)
+            self.done += len(lost)
+            self.items.clear()
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+
+    def stats(self):
+        return dict(queued=len(self.items), pending=self.enqueued - self.done, maxsize=self.maxsize,
+                    written=self.done - self.dropped, dropped=self.dropped)
+
+
+# 配置了写后队列的表 {表名: WriteBehind的参数}，由create_pool按配置设置
+_write_behind_options = dict()
+# {Model类: WriteBehind}
+_write_behinds = dict()
+
+
+def write_behind(model):
+    """ 返回model的写后队列，没有配置时返回None """
+    queue = _write_behinds.get(model)
+    if queue is None and model.__table__ in _write_behind_options:
+        queue = _write_behinds[model] = WriteBehind(model, **_write_behind_options[model.__table__])
+    return queue
+
+
+async def close_write_behind(timeout=None):
+    """ 写完所有写后队列中的对象；之后save_later()直接写入，直到再次create_pool """
+    queues = list(_write_behinds.values())
+    _write_behind_options.clear()
+    _write_behinds.clear()
+    for queue in queues:
+        await queue.close(timeout)
+
+
+def write_behind_stats():
+    return {model.__table__: queue.stats() for model, queue in _write_behinds.items()}
+
+
 # 1.定义Field类，它负责保存数据库表的字段名和字段类型：
 class Field(object):
 
-    def __init__(self, name, column_type, primary_key, default):
+    def __init__(self, name, column_type, primary_key, default, deferred=False, index=False, unique=False):
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        self.deferred = deferred  # 延迟加载：列表查询默认不取这一列，需要时再用Model.load()加载
+        self.index = index  # 为这一列建单列索引
+        self.unique = unique  # 为这一列建唯一索引
 
     def __str__(self):
         return '<%s, %s:%s>' % (self.__class__.__name__, self.column_type, self.name)
@@ -91,32 +1838,136 @@ class Field(object):
 # 2.在Field的基础上，进一步定义各种类型的Field，比如StringField，IntegerField等等：
 class StringField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)'):
-        super(StringField, self).__init__(name, ddl, primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)', deferred=False, index=False, unique=False):
+        super(StringField, self).__init__(name, ddl, primary_key, default, deferred, index, unique)
 
 
 class BooleanField(Field):
 
-    def __init__(self, name=None, default=False):
-        super().__init__(name, 'boolean', False, default)
+    def __init__(self, name=None, default=False, index=False):
+        super().__init__(name, 'boolean', False, default, index=index)
 
 
 class IntegerField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0):
-        super().__init__(name, 'bigint', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0, index=False, unique=False):
+        super().__init__(name, 'bigint', primary_key, default, index=index, unique=unique)
 
 
 class FloatField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0.0):
-        super().__init__(name, 'real', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0.0, index=False, unique=False):
+        super().__init__(name, 'real', primary_key, default, index=index, unique=unique)
 
 
 class TextField(Field):
 
-    def __init__(self, name=None, default=None):
-        super().__init__(name, 'text', False, default)
+    def __init__(self, name=None, default=None, deferred=False):
+        super().__init__(name, 'text', False, default, deferred)
+
+
+class Index(object):
+    """
+    Model上声明的索引，可以是多列的：
+
+        class Comment(Model):
+            __indexes__ = (Index('blog_id', 'created_at'),)
+
+    单列索引也可以直接写在Field上：StringField(index=True)或StringField(unique=True)。
+    """
+
+    def __init__(self, *columns, unique=False, name=None):
+        if not columns:
+            raise ValueError('Index needs at least one column.')
+        self.columns = tuple(columns)
+        self.unique = unique
+        self.name = name  # 为None时由ModelMetaclass按表名和列名生成
+
+    def ddl(self, table):
+        return 'create %sindex `%s` on `%s` (%s)' % (
+            'unique ' if self.unique else '', self.name, table, ', '.join('`%s`' % c for c in self.columns))
+
+    def __str__(self):
+        return '<%s%s: %s>' % ('Unique ' if self.unique else '', self.__class__.__name__, ','.join(self.columns))
+
+
+# 所有Model类，检查数据库索引时使用
+_models = []
+
+
+# 已确认数据库中存在的索引 {Model类: set((列, 是否唯一))}，由check_indexes()/create_tables()更新
+_existing_indexes = dict()
+
+
+async def missing_indexes(model):
+    """ 对照数据库中实际的索引，返回model声明了但表上没有的Index（按列和唯一性比较，不比较索引名） """
+    existing = await _backend.indexes(model.__table__)
+    _existing_indexes[model] = set(existing)
+    return [index for index in model.__indexes__ if (index.columns, index.unique) not in existing]
+
+
+def has_unique_index(model, *columns):
+    """
+    已确认columns上有唯一索引时返回True，可以依靠数据库拒绝重复的值（DuplicateKeyError）；
+    还没有检查过（check_indexes()/create_tables()）或确实缺少时返回False。
+    """
+    return (tuple(columns), True) in _existing_indexes.get(model, ())
+
+
+async def check_indexes(models=None):
+    """ 检查所有Model（或指定的models）的索引，缺少的索引记录警告并给出创建语句，返回{表名: [Index]} """
+    result = dict()
+    for model in models or _models:
+        missing = await missing_indexes(model)
+        if missing:
+            result[model.__table__] = missing
+            for index in missing:
+                logging.warning('missing index on %s: %s; to create: %s;' % (model.__table__, index, index.ddl(model.__table__)))
+    return result
+
+
+def schema_sql(models=None):
+    """ 所有Model（或指定的models）在当前后端上的建表和建索引语句 """
+    return '\n\n'.join('\n'.join([model.__create_table__ + _backend.table_options + ';']
+                                  + [sql + ';' for sql in model.__create_indexes__]) for model in models or _models)
+
+
+async def create_tables(models=None):
+    """ 创建不存在的表，再补建缺少的索引；用于sqlite后端或新建的数据库 """
+    for model in models or _models:
+        await execute(model.__create_table__ + _backend.table_options, None)
+        for index in await missing_indexes(model):
+            logging.info('creating index %s on %s' % (index.name, model.__table__))
+            await execute(index.ddl(model.__table__), None)
+            _existing_indexes[model].add((index.columns, index.unique))
+
+
+def make_row_loader(cls, columns):
+    """
+    生成按列顺序从tuple行直接构造对象的函数，相当于:
+
+        def from_row(row):
+            obj = object.__new__(cls)
+            c0, c1, ... = row
+            set_id(obj, c0)
+            set_name(obj, c1)
+            ...
+            return obj
+
+    不经过__init__，也不为每一行创建dict；直接调用slot描述符赋值，不经过Model.__setattr__，不会被记为修改过的列。
+    """
+    src = 'def from_row(row):\n    obj = new(cls)\n    %s, = row\n%s    return obj\n' % (
+        ', '.join('c%d' % i for i in range(len(columns))),
+        ''.join('    set_%d(obj, c%d)\n' % (i, i) for i in range(len(columns))))
+    namespace = dict(new=object.__new__, cls=cls)
+    for i, c in enumerate(columns):
+        namespace['set_%d' % i] = cls.__dict__[c].__set__
+    exec(src, namespace)
+    return namespace['from_row']
+
+
+# 表示属性没有赋值
+_MISSING = object()
 
 
 # 编写ModelMetaclass
@@ -153,29 +2004,138 @@ class ModelMetaclass(type):
         attrs['__table__'] = table_name  # 假设表名和类名一致
         attrs['__primary_key__'] = primary_key  # 主键属性名
         attrs['__fields__'] = fields  # 除了主键外的属性名
-        # 构造默认的SELECT, INSERT, UPDATE和DELETE语句
-        attrs['__select__'] = 'select `%s`, %s from `%s`' % (primary_key, ','.join(escaped_fields), table_name)
+        attrs['__columns__'] = (primary_key,) + tuple(fields)  # 所有列，也是行tuple中的顺序
+        attrs['__deferred__'] = tuple(f for f in fields if mappings[f].deferred)  # 延迟加载的列
+        attrs['__default_columns__'] = tuple(c for c in attrs['__columns__'] if c not in attrs['__deferred__'])
+        attrs['__loaders__'] = dict()  # {列tuple: 从行tuple构造对象的函数}
+        # 每一列用__slots__保存，不再为每个对象分配dict；其他属性（如html_content）仍然可以设置
+        # _dirty保存修改过的列名
+        attrs['__slots__'] = attrs['__columns__'] + ('_dirty',)
+        # 构造默认的SELECT, INSERT, UPDATE和DELETE语句，默认的SELECT不包含延迟加载的列
+        attrs['__select__'] = 'select %s from `%s`' % (','.join(map(lambda f: '`%s`' % f, attrs['__default_columns__'])), table_name)
         attrs['__insert__'] = \
             'insert into `%s` (%s, `%s`) values(%s)' % (table_name, ','.join(escaped_fields), primary_key, create_args_string(len(escaped_fields)+1))
         attrs['__update__'] = \
             'update `%s` set %s where `%s`=?' % (table_name, ','.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primary_key)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (table_name, primary_key)
-        return type.__new__(mcs, name, bases, attrs)
+        attrs['__upsert__'] = \
+            '%s on duplicate key update %s' % (attrs['__insert__'], ','.join(map(lambda f: '`{0}`=values(`{0}`)'.format(mappings.get(f).name or f), fields)))
+        # 索引：Field上声明的单列索引和__indexes__中的索引
+        indexes = [Index(f, unique=True) for f in fields if mappings[f].unique]
+        indexes.extend(Index(f) for f in fields if mappings[f].index and not mappings[f].unique)
+        for index in attrs.get('__indexes__', ()):
+            for c in index.columns:
+                if c not in mappings:
+                    raise RuntimeError('Index %s refers to unknown field: %s' % (index, c))
+            indexes.append(index)
+        for index in indexes:
+            # SQLite的索引名在整个数据库中唯一，默认名称带上表名
+            index.name = index.name or '%s_%s_%s' % ('uniq' if index.unique else 'idx', table_name, '_'.join(index.columns))
+        attrs['__indexes__'] = tuple(indexes)
+        # 建表语句（不含表选项，见schema_sql()），以及建索引的语句
+        attrs['__create_table__'] = 'create table if not exists `%s` (\n    %s\n)' % (table_name, ',\n    '.join(
+            ['`%s` %s not null' % (mappings[c].name or c, mappings[c].column_type) for c in attrs['__columns__']]
+            + ['primary key (`%s`)' % primary_key]))
+        attrs['__create_indexes__'] = tuple(i.ddl(table_name) for i in indexes)
+        cls = type.__new__(mcs, name, bases, attrs)
+        cls.__from_row__ = staticmethod(cls.row_loader(cls.__columns__))
+        _models.append(cls)
+        return cls
 
 
-class Model(dict, metaclass=ModelMetaclass):
+class Model(object, metaclass=ModelMetaclass):
+    """
+    每个Model子类的列都保存在__slots__里，没有赋值的列访问时抛出AttributeError。
+    to_dict()返回可以序列化为JSON的dict，也支持dict(model)和model['name']。
+    """
 
     def __init__(self, **kw):
-        super(Model, self).__init__(**kw)
+        for k, v in kw.items():
+            setattr(self, k, v)
 
-    def __getattr__(self, key):
+    def __getitem__(self, key):
         try:
-            return self[key]
-        except KeyError:
-            raise AttributeError(r"'Model' object has no attributes '%s'" % key)
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def keys(self):
+        return self.to_dict().keys()
+
+    def to_dict(self):
+        d = dict()
+        for k in self.__columns__:
+            try:
+                d[k] = getattr(self, k)
+            except AttributeError:
+                pass
+        d.update(self.__dict__)
+        return d
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.to_dict())
 
     def __setattr__(self, key, value):
-        self[key] = value
+        # 记录修改过的列，update()只写回这些列；赋的值与原值相同时不记录
+        if key in self.__mappings__ and getattr(self, key, _MISSING) != value:
+            try:
+                self._dirty.add(key)
+            except AttributeError:
+                object.__setattr__(self, '_dirty', {key})
+        object.__setattr__(self, key, value)
+
+    def changed(self):
+        """ 从数据库加载或写入之后修改过的列名 """
+        return getattr(self, '_dirty', None) or set()
+
+    def _mark_clean(self):
+        object.__setattr__(self, '_dirty', set())
+
+    def __getattr__(self, key):
+        # 只有正常查找失败（如slot未赋值）时才会调用
+        if key in self.__deferred__:
+            raise AttributeError(r"deferred column '%s' of '%s' is not loaded, use 'await obj.load()' first" % (key, self.__class__.__name__))
+        raise AttributeError(r"'%s' object has no attribute '%s'" % (self.__class__.__name__, key))
+
+    @classmethod
+    def row_loader(cls, columns):
+        """ 返回按columns顺序从行tuple构造对象的函数 """
+        loader = cls.__loaders__.get(columns)
+        if loader is None:
+            loader = cls.__loaders__[columns] = make_row_loader(cls, columns)
+        return loader
+
+    @classmethod
+    def projection(cls, columns=None):
+        """ 规范化要查询的列：None为默认列（不含延迟加载的列），总是包含主键，按__columns__排序 """
+        if columns is None:
+            return cls.__default_columns__
+        names = set(columns)
+        unknown = names.difference(cls.__columns__)
+        if unknown:
+            raise AttributeError(r"'%s' has no column %s" % (cls.__name__, ', '.join(sorted(unknown))))
+        names.add(cls.__primary_key__)
+        return tuple(c for c in cls.__columns__ if c in names)
+
+    @classmethod
+    def select_head(cls, columns):
+        """ 只查询columns的SELECT语句头 """
+        return cached_statement((cls, 'select', columns),
+                                lambda: 'select %s from `%s`' % (','.join(map(lambda f: '`%s`' % f, columns)), cls.__table__))
+
+    async def load(self, *names):
+        """ 加载尚未加载的列（默认为所有延迟加载的列），一次查询，返回self """
+        cls = self.__class__
+        names = names or cls.__deferred__
+        missing = tuple(c for c in cls.__columns__ if c in names and not hasattr(self, c))
+        if missing:
+            sql = cached_statement((cls, 'load', missing), lambda: '%s where `%s`=?' % (cls.select_head(missing), cls.__primary_key__))
+            rs = await select(sql, [self.getvalue(cls.__primary_key__)], 1, tuples=True)
+            if rs:
+                for k, v in zip(missing, rs[0]):
+                    # 从数据库加载的值不算修改
+                    object.__setattr__(self, k, v)
+        return self
 
     def getvalue(self, key):
         return getattr(self, key, None)
@@ -190,52 +2150,255 @@ class Model(dict, metaclass=ModelMetaclass):
                 setattr(self, key, value)
         return value
 
+    @classmethod
+    def column(cls, name):
+        """ 返回列表达式，用于构造查询条件和排序 """
+        if name != cls.__primary_key__ and name not in cls.__fields__:
+            raise AttributeError(r"'%s' has no column '%s'" % (cls.__name__, name))
+        return Column(name)
+
+    @classmethod
+    def query(cls, *exprs):
+        """ 返回查询构造器 """
+        return Query(cls).filter(*exprs)
+
+    @classmethod
+    async def find_page(cls, page_index=1, page_size=10, where=None, args=None, orderBy=None, after=None, before=None, columns=None):
+        """
+        分页查询，返回(对象列表, Page)，总数和这一页在一次往返中得到，见Query.page()。
+        orderBy是一列（默认为created_at desc），按这一列和主键排序，after/before是Page给出的游标。
+        """
+        if orderBy is None:
+            orderBy = 'created_at desc' if 'created_at' in cls.__mappings__ else '%s desc' % cls.__primary_key__
+        m = _RE_ORDER.match(orderBy)
+        if m is None:
+            raise ValueError('find_page needs orderBy on a single column: %s' % orderBy)
+        descending = (m.group(2) or '').lower() == 'desc'
+        q = Query(cls, Expr(where, args or []) if where else None,
+                  (Order(m.group(1), descending), Order(cls.__primary_key__, descending)), columns=columns)
+        return await q.page(page_index, page_size, after, before)
+
     @classmethod
     async def findall(cls, where=None, args=None, **kw):
-        """ find objects by where clause """
-        sql = [cls.__select__]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        if args is None:
-            args = []
-        orderby = kw.get('orgerBy', None)
-        if orderby:
-            sql.append('order by')
-            sql.append(orderby)
+        """
+        find objects by where clause
+
+        after=/before=是键集分页的边界(排序列的值, 主键)，此时orderBy只能是单列，
+        主键自动作为第二排序列，limit只能是整数。
+        columns=[...]只查询指定的列（总是包含主键），默认查询除延迟加载列以外的所有列。
+        """
+        orderby = kw.get('orgerBy', None) or kw.get('orderBy', None)
         limit = kw.get('limit', None)
-        if limit is not None:
-            sql.append('limit')
-            if isinstance(limit, int):
-                sql.append('?')
-                args.append(limit)
-            elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?, ?')
-                args.extend(limit)
-            else:
-                raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = await select(' '.join(sql), args)
-        return [cls(**r) for r in rs]
+        columns = cls.projection(kw.get('columns', None))
+        after, before = kw.get('after', None), kw.get('before', None)
+        if after is not None or before is not None:
+            m = _RE_ORDER.match(orderby or '')
+            if m is None:
+                raise ValueError('keyset pagination needs orderBy on a single column: %s' % orderby)
+            descending = (m.group(2) or '').lower() == 'desc'
+            q = Query(cls, Expr(where, args or []) if where else None,
+                      (Order(m.group(1), descending), Order(cls.__primary_key__, descending)), columns=columns)
+            q = q.after(after) if after is not None else q.before(before)
+            if limit is not None:
+                if not isinstance(limit, int):
+                    raise ValueError('Invalid limit value for keyset pagination: %s' % str(limit))
+                q = q.limit(limit)
+            return await q.all()
+        if limit is None:
+            limit_shape = 0
+        elif isinstance(limit, int):
+            limit_shape = 1
+        elif isinstance(limit, tuple) and len(limit) == 2:
+            limit_shape = 2
+        else:
+            raise ValueError('Invalid limit value: %s' % str(limit))
+
+        def build():
+            sql = [cls.select_head(columns)]
+            if where:
+                sql.append('where')
+                sql.append(where)
+            if orderby:
+                sql.append('order by')
+                sql.append(orderby)
+            if limit_shape:
+                sql.append('limit')
+                sql.append(create_args_string(limit_shape))
+            return ' '.join(sql)
+
+        sql = cached_statement((cls, 'findall', columns, where, orderby, limit_shape), build)
+        args = list(args) if args else []
+        if limit_shape == 1:
+            args.append(limit)
+        elif limit_shape == 2:
+            args.extend(limit)
+        rs = await select(sql, args, tuples=True)
+        from_row = cls.row_loader(columns)
+        return [from_row(r) for r in rs]
+
+    @classmethod
+    async def iterate(cls, where=None, args=None, chunk_size=1000, **kw):
+        """
+        逐行遍历查询结果，内存占用与表的大小无关：
+
+            async with contextlib.aclosing(Comment.iterate(chunk_size=500)) as comments:
+                async for c in comments:
+                    ...
+
+        提前break时用aclosing()包住，连接会立刻归还；否则要等生成器被回收时才归还。
+        """
+        orderby = kw.get('orgerBy', None) or kw.get('orderBy', None)
+        columns = cls.projection(kw.get('columns', None))
+
+        def build():
+            sql = [cls.select_head(columns)]
+            if where:
+                sql.append('where')
+                sql.append(where)
+            if orderby:
+                sql.append('order by')
+                sql.append(orderby)
+            return ' '.join(sql)
+
+        sql = cached_statement((cls, 'iterate', columns, where, orderby), build)
+        from_row = cls.row_loader(columns)
+        # 外层被aclose()时立刻关闭内层的select_stream，归还连接
+        async with contextlib.aclosing(select_stream(sql, args, chunk_size, tuples=True)) as chunks:
+            async for rs in chunks:
+                for r in rs:
+                    yield from_row(r)
 
     @classmethod
     async def findnumber(cls, selectField, where=None, args=None):
-        """ find number by select and where. """
-        sql = ['select %s _num_ from %s' % (selectField, cls.__table__)]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        rs = await select(' '.join(sql), args, 1)
+        """ find number by select and where. 不带条件的count(*)/count(主键)返回内存中维护的行数 """
+        if not where and _RE_COUNT_ALL.match(selectField) and _RE_COUNT_ALL.match(selectField).group(1) in ('*', cls.__primary_key__):
+            return await row_count(cls).get()
+        def build():
+            sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
+            if where:
+                sql.append('where')
+                sql.append(where)
+            return ' '.join(sql)
+
+        sql = cached_statement((cls, 'findnumber', selectField, where), build)
+        rs = await select(sql, args, 1)
         if len(rs) == 0:
             return None
         return rs[0]['_num_']
 
+    @classmethod
+    async def aggregate(cls, by, selectField='count(*)', where=None, args=None, keys=None, default=None):
+        """
+        按by列分组计算selectField（如count(*)、max(created_at)、sum(...)），返回{by列的值: 结果}，
+        只返回聚合结果，不加载行。by为多个列名的tuple时键也是tuple；selectField为tuple时结果是对应的tuple。
+        keys不为None时只统计by列的值在keys中的分组（by只能是一列），没有行的key结果为default，如
+        await Comment.aggregate('blog_id', keys=blog_ids, default=0)
+        """
+        names = (by,) if isinstance(by, str) else tuple(by)
+        fields = (selectField,) if isinstance(selectField, str) else tuple(selectField)
+        for name in names:
+            cls.column(name)
+        if keys is not None:
+            if len(names) != 1:
+                raise ValueError('keys requires a single group-by column')
+            keys = list(dict.fromkeys(keys))
+            if not keys:
+                return dict()
+        def build():
+            sql = ['select %s, %s from `%s`' % (', '.join('`%s`' % n for n in names), ', '.join(fields), cls.__table__)]
+            conditions = []
+            if where:
+                conditions.append('(%s)' % where)
+            if keys is not None:
+                conditions.append('`%s` in (%s)' % (names[0], create_args_string(len(keys))))
+            if conditions:
+                sql.append('where')
+                sql.append(' and '.join(conditions))
+            sql.append('group by %s' % ', '.join('`%s`' % n for n in names))
+            return ' '.join(sql)
+
+        sql = cached_statement((cls, 'aggregate', names, fields, where, None if keys is None else len(keys)), build)
+        rs = await select(sql, list(args or ()) + (keys or []), tuples=True)
+        n = len(names)
+        result = dict() if keys is None else dict.fromkeys(keys, default)
+        for r in rs:
+            key = r[0] if n == 1 else tuple(r[:n])
+            result[key] = r[n] if len(fields) == 1 else tuple(r[n:])
+        return result
+
     @classmethod
     async def find(cls, pk):
-        """ find object by primary key. """
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+        """ find object by primary key. 按主键查询时加载所有列，包括延迟加载的列 """
+        identity = _identity.get()
+        if identity is not None and (cls, pk) in identity:
+            r = identity[(cls, pk)]
+            return cls.__from_row__(r) if r is not None else None
+        sql = cached_statement((cls, 'find'), lambda: '%s where `%s`=?' % (cls.select_head(cls.__columns__), cls.__primary_key__))
+        rs = await select(sql, [pk], 1, tuples=True)
+        if identity is not None:
+            identity[(cls, pk)] = rs[0] if rs else None
         if len(rs) == 0:
             return None
-        return cls(**rs[0])
+        return cls.__from_row__(rs[0])
+
+    @classmethod
+    async def _find_rows(cls, pks):
+        """ 按主键批量查询完整的行，返回{主键: 行tuple}，先查身份映射，其余每500个主键一条IN查询 """
+        identity = _identity.get()
+        found = dict()
+        missing = []
+        for pk in dict.fromkeys(pks):
+            if identity is not None and (cls, pk) in identity:
+                if identity[(cls, pk)] is not None:
+                    found[pk] = identity[(cls, pk)]
+            else:
+                missing.append(pk)
+        for start in range(0, len(missing), 500):
+            batch = missing[start:start + 500]
+            sql = cached_statement((cls, 'find_many', len(batch)), lambda: '%s where `%s` in (%s)' % (
+                cls.select_head(cls.__columns__), cls.__primary_key__, create_args_string(len(batch))))
+            for r in await select(sql, batch, tuples=True):
+                found[r[0]] = r
+            if identity is not None:
+                for pk in batch:
+                    identity[(cls, pk)] = found.get(pk)
+        return found
+
+    @classmethod
+    async def find_many(cls, pks):
+        """ 按主键批量查询，返回{主键: 对象}，不存在的主键不在结果中 """
+        from_row = cls.__from_row__
+        return dict((pk, from_row(r)) for pk, r in (await cls._find_rows(pks)).items())
+
+    @classmethod
+    async def find_batched(cls, pk):
+        """
+        与find()相同，但同一轮事件循环中（包括不同请求的协程）对这个Model的调用会合并成一条IN查询。
+        本请求写过主库或在事务中时直接调用find()，保证读到刚写入的数据。
+        """
+        identity = _identity.get()
+        if (identity is not None and (cls, pk) in identity) or _wrote_primary.get() or _pinned.get() is not None:
+            return await cls.find(pk)
+        loader = _batch_loaders.get(cls)
+        if loader is None:
+            loader = _batch_loaders[cls] = BatchLoader(cls)
+        r = await loader.load(pk)
+        if identity is not None:
+            identity[(cls, pk)] = r
+        return cls.__from_row__(r) if r is not None else None
+
+    def _remember(self, removed=False):
+        """ 写入成功后同步请求级身份映射 """
+        identity = _identity.get()
+        if identity is not None:
+            key = (self.__class__, self.getvalue(self.__primary_key__))
+            if removed:
+                identity[key] = None
+            elif all(hasattr(self, c) for c in self.__columns__):
+                identity[key] = tuple(map(self.getvalue, self.__columns__))
+            else:
+                # 只加载了部分列的对象，无法代表完整的行
+                identity.pop(key, None)
 
     async def save(self):
         args = list(map(self.getvalue_or_default, self.__fields__))
@@ -243,13 +2406,161 @@ class Model(dict, metaclass=ModelMetaclass):
         rows = await execute(self.__insert__, args)
         if rows != 1:
             logging.warning('failed to insert record: affect row: %s' % rows)
+        row_count(self.__class__).add(rows)
+        self._mark_clean()
+        self._remember()
+
+    async def save_later(self, owner=None):
+        """
+        表配置了写后队列（db.write_behind）时放进队列就返回，稍后批量插入；owner（如作者的用户id）用于sync_writes()。
+        没有配置时等同于save()。
+        """
+        queue = write_behind(self.__class__)
+        if queue is None or queue.closed:
+            await self.save()
+        else:
+            await queue.put(self, owner)
+
+    @classmethod
+    async def sync_writes(cls, owner):
+        """ owner还有没写入的save_later()对象时等它们写完，读到自己刚写的数据 """
+        queue = _write_behinds.get(cls)
+        if queue is not None:
+            await queue.sync(owner)
+
+    @classmethod
+    async def save_many(cls, objects, batch_size=100):
+        """ 用多行INSERT批量插入，每批一次往返，返回每批影响的行数 """
+        objects = list(objects)
+        head, values = cls.__insert__.split(' values', 1)
+        results = []
+        for start in range(0, len(objects), batch_size):
+            batch = objects[start:start + batch_size]
+            sql = cached_statement((cls, 'save_many', len(batch)),
+                                   lambda: '%s values %s' % (head, ', '.join([values.strip()] * len(batch))))
+            args = []
+            for obj in batch:
+                args.extend(map(obj.getvalue_or_default, cls.__fields__))
+                args.append(obj.getvalue_or_default(cls.__primary_key__))
+            rows = await execute(sql, args)
+            if rows != len(batch):
+                logging.warning('failed to insert records: expect %s, affect row: %s' % (len(batch), rows))
+            row_count(cls).add(rows)
+            for obj in batch:
+                obj._mark_clean()
+                obj._remember()
+            results.append(rows)
+        return results
+
+    @classmethod
+    async def upsert_many(cls, objects, batch_size=100):
+        """
+        批量插入或更新（INSERT ... ON DUPLICATE KEY UPDATE），返回(inserted, updated)两个对象列表。
+        每批先用一条查询找出主键或唯一键（如users.email）已存在的行，再用一条多行语句写入。
+        主键是新的、唯一键已存在的对象更新的是已有的那一行，归入updated，身份映射中去掉这两个主键。
+        和其他请求并发写入同样的键时划分结果仍可能不准，因此这里不按划分结果增减行数，而是让内存中的行数在下次读取时重新查询。
+        """
+        objects = list(objects)
+        pk = cls.__primary_key__
+        head, rest = cls.__upsert__.split(' values', 1)
+        values, tail = rest.split(' on duplicate key update ', 1)
+        keys = [index.columns for index in cls.__indexes__ if index.unique]
+        column = lambda f: cls.__mappings__[f].name or f
+        key_of = lambda obj, fields: tuple(map(obj.getvalue_or_default, fields))
+
+        def existing_sql(n):
+            where = ['`%s` in (%s)' % (pk, create_args_string(n))]
+            for fields in keys:
+                if len(fields) == 1:
+                    where.append('`%s` in (%s)' % (column(fields[0]), create_args_string(n)))
+                else:
+                    where.append('(%s) in (%s)' % (', '.join('`%s`' % column(f) for f in fields),
+                                                   ', '.join(['(%s)' % create_args_string(len(fields))] * n)))
+            selected = [pk] + [column(f) for f in sorted(set(f for fields in keys for f in fields)) if f != pk]
+            return 'select %s from `%s` where %s' % (', '.join('`%s`' % c for c in selected), cls.__table__, ' or '.join(where))
+
+        inserted, updated = [], []
+        for start in range(0, len(objects), batch_size):
+            batch = objects[start:start + batch_size]
+            pks = [obj.getvalue_or_default(pk) for obj in batch]
+            args = list(pks)
+            for fields in keys:
+                for obj in batch:
+                    args.extend(key_of(obj, fields))
+            rows = await select(cached_statement((cls, 'existing', len(batch)), lambda: existing_sql(len(batch))), args, primary=True)
+            existing = set(r[pk] for r in rows)
+            # (唯一键, 值) -> 已存在的那一行的主键
+            owners = dict(((fields, tuple(r[column(f)] for f in fields)), r[pk]) for r in rows for fields in keys)
+            sql = cached_statement((cls, 'upsert_many', len(batch)),
+                                   lambda: '%s values %s on duplicate key update %s' % (head, ', '.join([values.strip()] * len(batch)), tail))
+            args = []
+            for obj in batch:
+                args.extend(map(obj.getvalue_or_default, cls.__fields__))
+                args.append(obj.getvalue_or_default(pk))
+            await execute(sql, args)
+            identity = _identity.get()
+            for obj, key in zip(batch, pks):
+                obj._mark_clean()
+                matched = [owners[(fields, key_of(obj, fields))] for fields in keys if (fields, key_of(obj, fields)) in owners]
+                if key in existing or not matched:
+                    (updated if key in existing else inserted).append(obj)
+                    obj._remember()
+                else:
+                    # 按唯一键更新了主键不同的那一行：这个主键的行并不存在，那一行的内容也变了
+                    updated.append(obj)
+                    if identity is not None:
+                        for old in [key] + matched:
+                            identity.pop((cls, old), None)
+            row_count(cls).stale()
+        return inserted, updated
+
+    @classmethod
+    def _update_sql(cls, fields):
+        if len(fields) == len(cls.__fields__):
+            return cls.__update__
+        return cached_statement((cls, 'update', fields), lambda: 'update `%s` set %s where `%s`=?' % (
+            cls.__table__, ','.join(map(lambda f: '`%s`=?' % (cls.__mappings__.get(f).name or f), fields)), cls.__primary_key__))
 
     async def update(self):
-        args = list(map(self.getvalue_or_default, self.__fields__))
+        """ 只写回修改过的列（没有加载的延迟列不会被覆盖），没有修改时不访问数据库；返回影响的行数 """
+        cls = self.__class__
+        changed = self.changed()
+        fields = tuple(f for f in cls.__fields__ if f in changed)
+        if not fields:
+            return 0
+        args = list(map(self.getvalue_or_default, fields))
         args.append(self.getvalue_or_default(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        rows = await execute(cls._update_sql(fields), args)
         if rows != 1:
             logging.warning('failed to update record: affect row: %s' % rows)
+        self._mark_clean()
+        self._remember()
+        return rows
+
+    @classmethod
+    async def update_by_pk(cls, pk, **changes):
+        """ 按主键更新指定的列，不需要先查询出对象，一次往返；返回影响的行数 """
+        unknown = set(changes).difference(cls.__fields__)
+        if unknown:
+            raise AttributeError(r"'%s' has no column %s" % (cls.__name__, ', '.join(sorted(unknown))))
+        fields = tuple(f for f in cls.__fields__ if f in changes)
+        if not fields:
+            return 0
+        rows = await execute(cls._update_sql(fields), [changes[f] for f in fields] + [pk])
+        identity = _identity.get()
+        if identity is not None:
+            identity.pop((cls, pk), None)
+        return rows
+
+    @classmethod
+    async def delete_by_pk(cls, pk):
+        """ 按主键删除，不需要先查询出对象，一次往返；返回影响的行数 """
+        rows = await execute(cls.__delete__, [pk])
+        row_count(cls).add(-rows)
+        identity = _identity.get()
+        if identity is not None:
+            identity[(cls, pk)] = None
+        return rows
 
     async def remove(self):
         logging.info('begin to delete')
@@ -257,3 +2568,5 @@ class Model(dict, metaclass=ModelMetaclass):
         rows = await execute(self.__delete__, args)
         if rows != 1:
             logging.warning('failed to delete record: affect row: %s' % rows)
+        row_count(self.__class__).add(-rows)
+        self._remember(removed=True)
@@ -0,0 +1,132 @@
+__author__ = 'Larry'
+
+
+'''
+Pagination shared by the data layer (orm) and the web layer (apis, handlers)
+'''
+
+import json, base64
+
+
+class Page(object):
+    '''
+    Page object for display pages.
+    '''
+
+    def __init__(self, item_count, page_index=1, page_size=10, after=None, before=None):
+        '''
+        Init Pagination by iten_count, page_index, page_size.
+
+        after/before are opaque cursors from a previous page. When one is given the page
+        is fetched by keyset (the sort values of the cursor's item) instead of offset, see Page.keyset.
+        An invalid cursor raises ValueError.
+
+        >>> p1 = Page(100,1)
+        >>> p1.page_count
+        10
+        >>> p1.offset
+        0
+        >>> p1.limit
+        10
+        >>> p2 = Page(90, 9, 10)
+        >>> p2.page_count
+        9
+        >>> p2.offset
+        80
+        >>> p2.limit
+        10
+        >>> p3 = Page(91, 10, 10)
+        >>> p3.page_count
+        10
+        >>> p3.offset
+        90
+        >>> p3.limit
+        10
+        '''
+        self.item_count = item_count
+        self.page_size = page_size
+        self.page_count = item_count // page_size + (1 if item_count % page_size > 0 else 0)
+        if (item_count == 0) or (page_index > self.page_count):
+            self.offset = 0
+            self.limit = 0
+            self.page_index = 1
+        else:
+            self.page_index = page_index
+            self.offset = self.page_size * (page_index-1)
+            self.limit = self.page_size
+        self.has_next = self.page_index < self.page_count
+        self.has_previous = self.page_index > 1
+        self.after = decode_cursor(after) if after else None
+        self.before = decode_cursor(before) if before and self.after is None else None
+        self.next_cursor = None
+        self.prev_cursor = None
+
+    @property
+    def keyset(self):
+        '''
+        True if the page should be fetched by keyset bounds (self.after / self.before).
+        '''
+        return self.after is not None or self.before is not None
+
+    def set_cursors(self, items, key):
+        '''
+        Set next_cursor / prev_cursor from the items of this page. key(item) returns the values
+        of the columns the page is sorted by.
+
+        >>> class Item(object):
+        ...     def __init__(self, name, id):
+        ...         self.name, self.id = name, id
+        >>> p = Page(30, 2)
+        >>> p.set_cursors([Item('c', 3), Item('b', 2)], lambda item: (item.name, item.id))
+        >>> Page(30, 3, after=p.next_cursor).after
+        ('b', 2)
+        >>> Page(30, 1, before=p.prev_cursor).before
+        ('c', 3)
+        '''
+        if items:
+            self.next_cursor = encode_cursor(key(items[-1])) if self.has_next else None
+            self.prev_cursor = encode_cursor(key(items[0])) if self.has_previous else None
+
+    def __str__(self):
+        return 'item_count: %s, page_count: %s, page_index: %s, page_size: %s, offset: %s, limit: %s' % (self.item_count, self.page_count, self.page_index, self.page_size, self.offset, self.limit)
+
+    __repr__ = __str__
+
+
+def encode_cursor(values):
+    '''
+    Encode the keyset position (the sort values of an item) as an url-safe opaque string.
+    '''
+    s = json.dumps(list(values), separators=(',', ':'))
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    '''
+    Decode a cursor made by encode_cursor() into a tuple of values.
+
+    >>> decode_cursor(encode_cursor((1.5, 'a')))
+    (1.5, 'a')
+    >>> decode_cursor('bad')
+    Traceback (most recent call last):
+        ...
+    ValueError: Invalid page cursor.
+    >>> decode_cursor(encode_cursor(([1, 2], 'a')))
+    Traceback (most recent call last):
+        ...
+    ValueError: Invalid page cursor.
+    '''
+    try:
+        s = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        values = json.loads(s)
+    except (ValueError, TypeError, UnicodeDecodeError):
+        raise ValueError('Invalid page cursor.')
+    if not isinstance(values, list) or not values \
+            or not all(v is None or isinstance(v, (str, int, float, bool)) for v in values):
+        raise ValueError('Invalid page cursor.')
+    return tuple(values)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
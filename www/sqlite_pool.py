@@ -0,0 +1,220 @@
+__author__ = 'Larry'
+
+'''
+与aiomysql接口相同的SQLite连接池，供orm的sqlite后端使用。
+
+每个连接有自己的线程，查询都在这个线程上执行，不会阻塞事件循环；数据库使用WAL模式，读写可以并发。
+'''
+
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import sqlite3
+
+OperationalError = sqlite3.OperationalError
+IntegrityError = sqlite3.IntegrityError
+
+
+class Cursor(object):
+    """ 每行返回tuple；SQLite的游标本来就是逐行读取的，所以SSCursor就是Cursor """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._cur = None
+        self.description = None
+        self.rowcount = -1
+        self.lastrowid = None
+
+    def _row(self, row):
+        return row
+
+    def _execute(self, sql, args):
+        if self._cur is None:
+            self._cur = self._conn._db.cursor()
+        self._cur.execute(sql, args)
+        self.description = self._cur.description
+        self.rowcount = self._cur.rowcount
+        self.lastrowid = self._cur.lastrowid
+        return self.rowcount
+
+    def _fetch(self, size):
+        if self._cur is None:
+            return []
+        rows = self._cur.fetchall() if size is None else self._cur.fetchmany(size)
+        return [self._row(r) for r in rows]
+
+    async def execute(self, sql, args=()):
+        return await self._conn._run(self._execute, sql, tuple(args or ()))
+
+    async def fetchall(self):
+        return await self._conn._run(self._fetch, None)
+
+    async def fetchmany(self, size=None):
+        return await self._conn._run(self._fetch, size or 1)
+
+    async def fetchone(self):
+        rs = await self._conn._run(self._fetch, 1)
+        return rs[0] if rs else None
+
+    async def close(self):
+        if self._cur is not None and not self._conn.closed:
+            await self._conn._run(self._cur.close)
+        self._cur = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def __await__(self):
+        # 兼容 cur = await conn.cursor(...) 的写法
+        yield from ()
+        return self
+
+
+class DictCursor(Cursor):
+    """ 每行返回{列名: 值} """
+
+    def _row(self, row):
+        return dict(zip([d[0] for d in self.description], row))
+
+
+SSCursor = Cursor
+SSDictCursor = DictCursor
+
+
+class Connection(object):
+
+    def __init__(self, database, timeout):
+        self.database = database
+        self.timeout = timeout
+        self.closed = False
+        self._db = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+
+    def _run(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _open(self):
+        # isolation_level=None：由begin()/commit()显式控制事务，其余语句自动提交
+        db = sqlite3.connect(self.database, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+        db.execute('pragma journal_mode=wal')
+        db.execute('pragma synchronous=normal')
+        self._db = db
+
+    async def connect(self):
+        await self._run(self._open)
+        return self
+
+    def cursor(self, cursor_class=Cursor):
+        return cursor_class(self)
+
+    async def begin(self):
+        # 开始时就取得写锁，避免两个事务都从读升级为写时互相等待
+        await self._run(self._db.execute, 'begin immediate')
+
+    async def commit(self):
+        await self._run(self._db.execute, 'commit')
+
+    async def rollback(self):
+        if self._db.in_transaction:
+            await self._run(self._db.execute, 'rollback')
+
+    async def ping(self, reconnect=False):
+        pass
+
+    def interrupt(self):
+        """ 中止这个连接上正在执行的查询，可以在任何线程调用 """
+        if self._db is not None:
+            self._db.interrupt()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._db is not None:
+            self._executor.submit(self._db.close)
+        self._executor.shutdown(wait=False)
+
+
+class Pool(object):
+
+    def __init__(self, database, minsize, maxsize, timeout):
+        self.database = database
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._free = collections.deque()
+        self._used = set()
+        self._connecting = 0
+        self._cond = asyncio.Condition()
+        self._closing = False
+
+    @property
+    def size(self):
+        return len(self._free) + len(self._used) + self._connecting
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    async def _connect(self):
+        self._connecting += 1
+        try:
+            return await Connection(self.database, self.timeout).connect()
+        finally:
+            self._connecting -= 1
+
+    async def fill(self):
+        while self.size < self.minsize:
+            self._free.append(await self._connect())
+
+    async def acquire(self):
+        if self._closing:
+            raise RuntimeError('Cannot acquire connection after closing pool')
+        async with self._cond:
+            while True:
+                while self._free:
+                    conn = self._free.popleft()
+                    if not conn.closed:
+                        self._used.add(conn)
+                        return conn
+                if self.size < self.maxsize:
+                    conn = await self._connect()
+                    self._used.add(conn)
+                    return conn
+                await self._cond.wait()
+
+    def release(self, conn):
+        """ 归还连接；已关闭的连接、还在事务中的连接直接丢弃 """
+        self._used.discard(conn)
+        if not conn.closed and (self._closing or conn._db.in_transaction):
+            if conn._db.in_transaction:
+                logging.warning('sqlite connection released in transaction, closing it')
+            conn.close()
+        if not conn.closed:
+            self._free.append(conn)
+        asyncio.ensure_future(self._wakeup())
+
+    async def _wakeup(self):
+        async with self._cond:
+            self._cond.notify()
+
+    def close(self):
+        self._closing = True
+        while self._free:
+            self._free.popleft().close()
+
+    async def wait_closed(self):
+        while self._used:
+            async with self._cond:
+                await self._cond.wait()
+
+
+async def create_pool(database, minsize=1, maxsize=10, timeout=5.0, loop=None):
+    """ database为数据库文件名；timeout为等待其他连接释放写锁的秒数 """
+    pool = Pool(database, minsize, maxsize, timeout)
+    await pool.fill()
+    return pool
@@ -118,9 +118,14 @@ function parseQueryString() {
     return r;
 }
 
-function gotoPage(i) {
+function gotoPage(i, key, cursor) {
     var r = parseQueryString();
     r.page = i;
+    delete r.after;
+    delete r.before;
+    if (key && cursor) {
+        r[key] = cursor;
+    }
     location.assign('?' + $.param(r));
 }
 
@@ -360,10 +365,10 @@ if (typeof(Vue)!=='undefined') {
     Vue.component('pagination', {
         template: '<ul class="uk-pagination">' +
                 '<li v-if="! has_previous" class="uk-disabled"><span><i class="uk-icon-angle-double-left"></i></span></li>' +
-                '<li v-if="has_previous"><a v-attr="onclick:\'gotoPage(\' + (page_index-1) + \')\'" href="#0"><i class="uk-icon-angle-double-left"></i></a></li>' +
+                '<li v-if="has_previous"><a v-attr="onclick:\'gotoPage(\' + (page_index-1) + \', \\\'before\\\', \\\'\' + (prev_cursor || \'\') + \'\\\')\'" href="#0"><i class="uk-icon-angle-double-left"></i></a></li>' +
                 '<li class="uk-active"><span v-text="page_index"></span></li>' +
                 '<li v-if="! has_next" class="uk-disabled"><span><i class="uk-icon-angle-double-right"></i></span></li>' +
-                '<li v-if="has_next"><a v-attr="onclick:\'gotoPage(\' + (page_index+1) + \')\'" href="#0"><i class="uk-icon-angle-double-right"></i></a></li>' +
+                '<li v-if="has_next"><a v-attr="onclick:\'gotoPage(\' + (page_index+1) + \', \\\'after\\\', \\\'\' + (next_cursor || \'\') + \'\\\')\'" href="#0"><i class="uk-icon-angle-double-right"></i></a></li>' +
             '</ul>'
     });
 }
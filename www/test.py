@@ -1,6 +1,6 @@
 import orm
 from models import User, Blog, Comment
-import asyncio
+import asyncio, contextlib, os, sys, tempfile
 
 
 async def test(loop):
@@ -12,6 +12,378 @@ async def test(loop):
     await orm.destroy_pool()
 
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete(test(loop))
-loop.close()
+# 以下用例使用sqlite后端，在临时目录中建库，不需要MySQL：python3 test.py
+# 只运行上面连接MySQL的test：python3 test.py mysql
+
+async def sqlite_pool(**kw):
+    path = os.path.join(tempfile.mkdtemp(), 'test.db')
+    kw.setdefault('warmup', 1)
+    await orm.create_pool(None, backend='sqlite', database=path, **kw)
+    await orm.create_tables()
+
+
+async def test_save_many():
+    """ save_many()按batch_size分批插入，返回每批影响的行数 """
+    await sqlite_pool()
+    try:
+        assert await Comment.findnumber('count(*)') == 0
+        comments = [Comment(blog_id='b', user_id='u', user_name='n', user_image='i', content=str(i)) for i in range(5)]
+        assert await Comment.save_many(comments, batch_size=2) == [2, 2, 1]
+        assert sorted(c.content for c in await Comment.findall()) == ['0', '1', '2', '3', '4']
+        assert await Comment.findnumber('count(*)') == 5
+    finally:
+        await orm.destroy_pool()
+
+
+async def test_findall_keyset():
+    """ findall(after=/before=)按(排序列, 主键)翻页，排序列的值相同时也不重复、不遗漏 """
+    await sqlite_pool()
+    try:
+        blogs = [Blog(name='b%d' % (i // 2), summary='s', content='c', user_id='u', user_name='n', user_image='i')
+                 for i in range(6)]
+        await Blog.save_many(blogs)
+        ordered = [b.id for b in sorted(blogs, key=lambda b: (b.name, b.id))]
+        first = await Blog.findall(orderBy='name asc', limit=3, after=('', ''))
+        second = await Blog.findall(orderBy='name asc', limit=3, after=(first[-1].name, first[-1].id))
+        assert [b.id for b in first + second] == ordered
+        back = await Blog.findall(orderBy='name asc', limit=3, before=(second[0].name, second[0].id))
+        assert [b.id for b in back] == ordered[:3]
+    finally:
+        await orm.destroy_pool()
+
+
+async def test_identity_map():
+    """ 请求中按主键重复查询同一行（包括不存在的行）只访问一次数据库，写入后读到的是新值 """
+    await sqlite_pool()
+    try:
+        blog = Blog(name='b', summary='s', content='c', user_id='u', user_name='n', user_image='i')
+        await blog.save()
+        with orm.request_scope() as timing:
+            first = await Blog.find(blog.id)
+            assert await Blog.find('missing') is None
+            queries = timing.queries
+            second = await Blog.find(blog.id)
+            assert await Blog.find('missing') is None
+            assert timing.queries == queries
+            assert second is not first and second.name == 'b'
+            second.name = 'changed'
+            await second.update()
+            assert (await Blog.find(blog.id)).name == 'changed'
+    finally:
+        await orm.destroy_pool()
+
+
+async def test_transaction_commit_and_rollback():
+    """ 事务正常退出时提交，抛出异常时回滚，行数也只计入提交的写入 """
+    await sqlite_pool()
+    try:
+        assert await Comment.findnumber('count(*)') == 0
+        async with orm.transaction():
+            await Comment(blog_id='b', user_id='u', user_name='n', user_image='i', content='kept').save()
+        try:
+            async with orm.transaction():
+                await Comment(blog_id='b', user_id='u', user_name='n', user_image='i', content='lost').save()
+                raise RuntimeError('roll back')
+        except RuntimeError:
+            pass
+        assert [c.content for c in await Comment.findall()] == ['kept']
+        assert await Comment.findnumber('count(*)') == 1
+    finally:
+        await orm.destroy_pool()
+
+
+async def test_find_batched_coalesces():
+    """ 同一轮事件循环中的find_batched()合并成一条查询 """
+    await sqlite_pool()
+    try:
+        blogs = [Blog(name='b%d' % i, summary='s', content='c', user_id='u', user_name='n', user_image='i') for i in range(3)]
+        await Blog.save_many(blogs)
+        with orm.request_scope():
+            queries = orm.pool_stats()['primary']['query_ms']['count']
+            found = await asyncio.gather(*[Blog.find_batched(b.id) for b in blogs], Blog.find_batched('missing'))
+            assert orm.pool_stats()['primary']['query_ms']['count'] == queries + 1
+        assert [b.name for b in found[:3]] == ['b0', 'b1', 'b2'] and found[3] is None
+    finally:
+        await orm.destroy_pool()
+
+
+async def test_aggregate():
+    """ aggregate()按列分组返回{值: 结果}，keys中没有行的值返回default """
+    await sqlite_pool()
+    try:
+        await Comment.save_many([Comment(blog_id=blog_id, user_id='u', user_name='n', user_image='i', content=str(i))
+                                 for i, blog_id in enumerate(['a', 'a', 'b'])])
+        assert await Comment.aggregate('blog_id') == {'a': 2, 'b': 1}
+        assert await Comment.aggregate('blog_id', keys=['a', 'c'], default=0) == {'a': 2, 'c': 0}
+        assert await Comment.aggregate('blog_id', ('count(*)', 'max(content)')) == {'a': (2, '1'), 'b': (1, '2')}
+    finally:
+        await orm.destroy_pool()
+
+
+async def test_update_writes_changed_fields():
+    """ update()只写回修改过的列，不覆盖其他人改过的列和没有加载的延迟列；没有修改时不访问数据库 """
+    await sqlite_pool()
+    try:
+        blog = Blog(name='b', summary='s', content='c', user_id='u', user_name='n', user_image='i')
+        await blog.save()
+        loaded = (await Blog.findall('id=?', [blog.id]))[0]
+        await orm.execute('update `blogs` set `summary`=? where `id`=?', ['other', blog.id])
+        loaded.name = 'renamed'
+        assert await loaded.update() == 1
+        assert await loaded.update() == 0
+        row = await Blog.find(blog.id)
+        assert (row.name, row.summary, row.content) == ('renamed', 'other', 'c')
+    finally:
+        await orm.destroy_pool()
+
+
+async def test_delete_by_pk():
+    """ delete_by_pk()返回删除的行数，同步行数和身份映射 """
+    await sqlite_pool()
+    try:
+        blog = Blog(name='b', summary='s', content='c', user_id='u', user_name='n', user_image='i')
+        await blog.save()
+        assert await Blog.findnumber('count(*)') == 1
+        with orm.request_scope():
+            assert await Blog.find(blog.id) is not None
+            assert await Blog.delete_by_pk(blog.id) == 1
+            assert await Blog.find(blog.id) is None
+        assert await Blog.delete_by_pk(blog.id) == 0
+        assert await Blog.find(blog.id) is None
+        assert await Blog.findnumber('count(*)') == 0
+    finally:
+        await orm.destroy_pool()
+
+
+async def test_pinned_request_connections():
+    """ 连接池被各请求固定的连接占满时，请求中gather()的查询在请求自己的连接上排队，不会互相等待 """
+    await sqlite_pool(maxsize=2, pin_request_connection=True)
+    try:
+        async def request():
+            with orm.request_scope():
+                await Blog.findall('name=?', ['x'])
+                await orm.gather(Blog.findall('name=?', ['x']), Comment.findall('blog_id=?', ['x']))
+
+        await asyncio.wait_for(asyncio.gather(request(), request()), 5)
+        assert orm.pool_stats()['primary']['in_use'] == 0
+    finally:
+        await orm.destroy_pool()
+
+
+async def test_iterate_in_transaction():
+    """ 在事务中边遍历边写入，不会因为遍历占着事务的连接而卡住 """
+    await sqlite_pool()
+    try:
+        await Comment.save_many([Comment(blog_id='b', user_id='u', user_name='n', user_image='i', content='x') for _ in range(3)])
+        async with orm.transaction():
+            async for c in Comment.iterate(chunk_size=2):
+                c.content = 'y'
+                await asyncio.wait_for(c.update(), 5)
+        assert await Comment.findnumber('count(*)', 'content=?', ['y']) == 3
+    finally:
+        await orm.destroy_pool()
+
+
+async def test_query_cache_after_write():
+    """ 和写入同时进行的查询不能把旧数据放回缓存；写过主库的请求不读缓存 """
+    await sqlite_pool(cache=dict(enabled=True, ttl=60))
+    try:
+        blog = Blog(name='b', summary='s', content='x', user_id='u', user_name='n', user_image='i')
+        await blog.save()
+        slow = 'with recursive c(n) as (select 1 union all select n+1 from c where n < 300000) ' \
+               'select `content` from `blogs` where (select count(*) from c) > 0'
+        reading = asyncio.ensure_future(orm.select(slow, None))
+        await asyncio.sleep(0.05)
+        await orm.execute('update `blogs` set `content`=?', ['NEW'])
+        assert (await reading)[0]['content'] == 'x'
+        assert (await orm.select(slow, None))[0]['content'] == 'NEW'
+
+        sql = 'select `content` from `blogs` where `id`=?'
+        with orm.request_scope():
+            await orm.execute('update `blogs` set `content`=?', ['NEWER'])
+            # 别的请求从延迟的从库读到旧数据放进了缓存
+            cache = orm._query_cache
+            cache.put(cache.key(sql, [blog.id], None, False), [dict(content='NEW')], cache.generation())
+            assert (await orm.select(sql, [blog.id]))[0]['content'] == 'NEWER'
+    finally:
+        await orm.destroy_pool()
+
+
+async def test_find_page_cursor_by_order():
+    """ 游标按查询的排序列生成，不是created_at时也能翻到下一页 """
+    await sqlite_pool()
+    try:
+        await Blog.save_many([Blog(name='b%02d' % i, summary='s', content='c', user_id='u', user_name='n', user_image='i')
+                              for i in range(12)])
+        first, p = await Blog.find_page(1, 5, orderBy='name asc')
+        second, p2 = await Blog.find_page(2, 5, orderBy='name asc', after=p.next_cursor)
+        assert [b.name for b in first] == ['b%02d' % i for i in range(5)]
+        assert [b.name for b in second] == ['b%02d' % i for i in range(5, 10)]
+        back, _ = await Blog.find_page(1, 5, orderBy='name asc', before=p2.prev_cursor)
+        assert [b.name for b in back] == [b.name for b in first]
+        try:
+            await Blog.find_page(2, 5, after='bad')
+            assert False
+        except ValueError:
+            pass
+    finally:
+        await orm.destroy_pool()
+
+
+async def test_write_behind_close_timeout():
+    """ 关闭时数据库不可用，写后队列等待WRITE_BEHIND_CLOSE_TIMEOUT后放弃，不会一直重试下去 """
+    await sqlite_pool(write_behind=dict(comments=dict(interval=0.01)))
+
+    async def database_down(objects, batch_size):
+        raise OSError('database is down')
+
+    Comment.save_many = database_down
+    try:
+        await Comment(blog_id='b', user_id='u', user_name='n', user_image='i', content='x').save_later()
+    finally:
+        try:
+            await asyncio.wait_for(orm.destroy_pool(write_behind_timeout=0.5), 5)
+        finally:
+            del Comment.save_many
+
+
+async def test_unique_index_confirmed():
+    """ 只有确认email上有唯一索引后，注册才依靠数据库拒绝重复的email """
+    path = os.path.join(tempfile.mkdtemp(), 'test.db')
+    await orm.create_pool(None, backend='sqlite', database=path, warmup=1)
+    try:
+        assert not orm.has_unique_index(User, 'email')
+        # 没有唯一索引的旧数据库
+        await orm.execute(User.__create_table__, None)
+        await orm.check_indexes([User])
+        assert not orm.has_unique_index(User, 'email')
+        await orm.create_tables([User])
+        assert orm.has_unique_index(User, 'email')
+    finally:
+        await orm.destroy_pool()
+
+
+async def test_recorder_redacts_args():
+    """ /api/metrics返回的查询记录中不含写入语句和users表查询的参数 """
+    await sqlite_pool(recorder=dict(slow_ms=10000, sample_rate=1))
+    try:
+        await User(name='n', email='e@example.com', passwd='secret', image='i').save()
+        await User.findall('email=?', ['e@example.com'])
+        await Blog.findall('name=?', ['visible'])
+        samples = orm.query_stats()['samples']
+        assert 'secret' not in str(samples) and 'e@example.com' not in str(samples)
+        assert any(s['args'] == ['visible'] for s in samples)
+    finally:
+        await orm.destroy_pool()
+
+
+async def test_iterate_break_returns_connection():
+    """ 用aclosing()包住iterate()时，提前退出后连接立刻归还 """
+    await sqlite_pool()
+    try:
+        await Comment.save_many([Comment(blog_id='b', user_id='u', user_name='n', user_image='i', content='x') for _ in range(3)])
+        async with contextlib.aclosing(Comment.iterate(chunk_size=1)) as comments:
+            async for c in comments:
+                break
+        assert orm.pool_stats()['primary']['in_use'] == 0
+    finally:
+        await orm.destroy_pool()
+
+
+async def test_upsert_many_row_count():
+    """ 主键是新的但email已存在时，upsert_many()更新了已有的行：归入updated，行数不变，身份映射中没有不存在的行 """
+    await sqlite_pool()
+    try:
+        a = User(name='a', email='a@example.com', passwd='p', image='i')
+        await a.save()
+        assert await User.findnumber('count(*)') == 1
+        with orm.request_scope():
+            assert (await User.find(a.id)).name == 'a'
+            b = User(name='b', email='a@example.com', passwd='p', image='i')
+            inserted, updated = await User.upsert_many([b])
+            assert inserted == [] and updated == [b]
+            assert await User.find(b.id) is None
+            assert (await User.find(a.id)).name == 'b'
+        await User.findnumber('count(*)')
+        # 第一次读取在后台重新查询，等它完成
+        await asyncio.sleep(0.1)
+        assert await User.findnumber('count(*)') == 1
+    finally:
+        await orm.destroy_pool()
+
+
+async def test_write_behind_full_with_pinned_connections():
+    """ 写后队列满时，占着固定连接等待的请求先归还空闲连接，后台写入才取得到连接，不会卡死 """
+    await sqlite_pool(maxsize=2, warmup=2, pin_request_connection=True, request_timeout=3,
+                      write_behind=dict(comments=dict(maxsize=1, batch_size=1)))
+    try:
+        async def request(i):
+            with orm.request_scope():
+                await Blog.findall('name=?', ['x'])
+                # 第二条入队时队列一定是满的
+                for j in range(2):
+                    await Comment(blog_id='b', user_id='u', user_name='n', user_image='i', content=str(j)).save_later()
+
+        await asyncio.wait_for(asyncio.gather(*[request(i) for i in range(20)]), 10)
+        await orm.write_behind(Comment).flush()
+        assert await Comment.findnumber('count(*)') == 40
+    finally:
+        await orm.destroy_pool()
+
+
+async def test_row_count_add_during_reconcile():
+    """ 后台重新查询行数期间计入的增减不会被查询结果覆盖 """
+    await sqlite_pool()
+    try:
+        await Comment(blog_id='b', user_id='u', user_name='n', user_image='i', content='x').save()
+        counter = orm.RowCount(Comment)
+        assert await counter.get() == 1
+        counter.reconciled_at = 0
+        await counter.get()
+        # 查询开始后才提交的写入
+        counter.add(1)
+        await asyncio.sleep(0.1)
+        assert counter._reconciling is None and await counter.get() == 2
+    finally:
+        await orm.destroy_pool()
+
+
+async def test_state_reset_between_pools():
+    """ 行数、已确认的索引和查询缓存不会从上一个连接池带到下一个 """
+    await sqlite_pool(cache=dict(enabled=True, ttl=60))
+    try:
+        await Comment(blog_id='b', user_id='u', user_name='n', user_image='i', content='x').save()
+        assert await Comment.findnumber('count(*)') == 1
+        assert orm.has_unique_index(User, 'email')
+    finally:
+        await orm.destroy_pool()
+    assert orm._query_cache is None and not orm.has_unique_index(User, 'email')
+    await sqlite_pool()
+    try:
+        assert await Comment.findnumber('count(*)') == 0
+    finally:
+        await orm.destroy_pool()
+
+
+async def test_gather_keeps_wrote_primary():
+    """ gather()的加载中写过主库后，请求之后的读也走主库 """
+    await sqlite_pool()
+    try:
+        with orm.request_scope():
+            await orm.gather(Blog.findall('name=?', ['x']),
+                             Comment(blog_id='b', user_id='u', user_name='n', user_image='i', content='x').save())
+            assert orm._wrote_primary.get()
+    finally:
+        await orm.destroy_pool()
+
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    if sys.argv[1:] == ['mysql']:
+        loop.run_until_complete(test(loop))
+    else:
+        for name, fn in list(globals().items()):
+            if name.startswith('test_'):
+                loop.run_until_complete(fn())
+                print('%s ok' % name)
+    loop.close()